@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+# Response time bins shared by the cube and response_time_distplot
+RESPONSE_TIME_BINS = [0, 10, 60, 300, 1200, 3600, 18000, 43200, 172800, 604800, 2592000, 7776000, 15768000, 31536000,
+                      94608000]
+RESPONSE_TIME_LABELS = ['0-10secs', '10-60secs', '1-5mins', '5-20mins', '20mins-1hr', '1-5hrs', '5-12hrs',
+                        '12hrs-2days', '2days-1week', '1week-1month', '1month-3months', '3-6months', '6months-1year',
+                        '1year-3years']
+RESPONSE_TIME_COLUMNS = ['rt_' + label for label in RESPONSE_TIME_LABELS]
+
+# One cube row per (hour, chat, direction), every dashboard filter and figure grouping is a subset of these keys
+CUBE_KEYS = ['datetime', 'platform', 'chat_id', 'chat_name', 'chat_type', 'sent']
+
+# Response time sketches: log-bucketed histograms per (day, chat, direction), merged by adding their counts.
+# Bucket b holds response times in [SKETCH_BASE ** b, SKETCH_BASE ** (b + 1)) seconds (bucket 0 also holds
+# anything under a second), so a quantile read from the buckets is within 10% of the exact one.
+SKETCH_BASE = 2 ** 0.125
+
+# Trend rollups: messages and words per (period, chat, direction) at day, week and month granularity, keyed by the
+# first day of the period (weeks start on Monday). msg_store stores the rollups of every part at ingest, rollups of
+# disjoint messages are merged by adding their counts.
+ROLLUP_GRANULARITIES = ['day', 'week', 'month']
+
+
+def response_time_bin_codes(response_time):
+    # Index into RESPONSE_TIME_LABELS, -1 when there is no response time or it falls outside the bins
+    seconds = response_time.dt.total_seconds()
+    codes = pd.cut(seconds, bins=RESPONSE_TIME_BINS, labels=False, right=False)
+    return codes.fillna(-1).astype('int8')
+
+
+@stage
+def build_message_cube(msg_df):
+    # datetime is floored to the hour, so the cube is keyed by (date, hour, weekday, platform, chat, chat_type, sent)
+    frame = pd.DataFrame({key: msg_df[key] for key in CUBE_KEYS})
+    frame['datetime'] = msg_df['datetime'].dt.floor('h')
+    frame['word_count'] = msg_df['word_count'].astype('int64')
+    frame['rt_bin'] = response_time_bin_codes(msg_df['response_time'])
+
+    cube = frame.groupby(CUBE_KEYS, observed=True, dropna=False).agg(
+        message_count=('word_count', 'size'),
+        word_count=('word_count', 'sum')
+    )
+
+    # Response time bin counts, one column per bin
+    rt_counts = frame[frame['rt_bin'] >= 0].groupby(CUBE_KEYS + ['rt_bin'], observed=True, dropna=False).size()
+    rt_counts = rt_counts.unstack('rt_bin', fill_value=0).reindex(columns=range(len(RESPONSE_TIME_LABELS)),
+                                                                  fill_value=0)
+    rt_counts.columns = RESPONSE_TIME_COLUMNS
+    cube = cube.join(rt_counts)
+    cube[RESPONSE_TIME_COLUMNS] = cube[RESPONSE_TIME_COLUMNS].fillna(0).astype('int32')
+
+    cube = cube.reset_index().sort_values('datetime', kind='stable', ignore_index=True)
+    cube.insert(1, 'hour', cube['datetime'].dt.hour.astype('int8'))
+    cube.insert(2, 'weekday', cube['datetime'].dt.dayofweek.astype('int8'))
+    cube.insert(cube.columns.get_loc('sent') + 1, 'received', ~cube['sent'])
+    return cube
+
+
+def rollup_start(datetimes, granularity):
+    # First day of the period of granularity every datetime falls in
+    day = datetimes.dt.floor('D')
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - pd.to_timedelta(day.dt.dayofweek, unit='D')
+    return pd.Series(day.to_numpy().astype('datetime64[M]').astype(day.dtype), index=day.index, name=day.name)
+
+
+def _rollup_table(rollup, granularity):
+    rollup = rollup.reset_index().sort_values('datetime', kind='stable', ignore_index=True)
+    rollup.insert(rollup.columns.get_loc('sent') + 1, 'received', ~rollup['sent'].astype(bool))
+    rollup['granularity'] = granularity
+    return rollup
+
+
+@stage
+def build_rollup(msg_df, granularity):
+    # One row per (period, chat, direction) with its message and word counts, sorted by datetime like the cube
+    frame = pd.DataFrame({key: msg_df[key] for key in CUBE_KEYS})
+    frame['datetime'] = rollup_start(msg_df['datetime'], granularity)
+    frame['word_count'] = msg_df['word_count'].astype('int64')
+    rollup = frame.groupby(CUBE_KEYS, observed=True, dropna=False).agg(
+        message_count=('word_count', 'size'),
+        word_count=('word_count', 'sum')
+    )
+    return _rollup_table(rollup, granularity)
+
+
+def merge_rollups(rollups, granularity):
+    # Rollups of disjoint messages (the parts of msg_store) added up into one
+    rollup = pd.concat(rollups, ignore_index=True)
+    rollup = rollup.groupby(CUBE_KEYS, observed=True, dropna=False)[['message_count', 'word_count']].sum()
+    return _rollup_table(rollup, granularity)
+
+
+def response_time_buckets(response_time):
+    # Sketch bucket of every response time, -1 when there is none
+    seconds = response_time.dt.total_seconds().to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        buckets = np.floor(np.log(np.maximum(seconds, 1)) / np.log(SKETCH_BASE))
+    return pd.Series(np.where(np.isnan(seconds), -1, buckets).astype('int16'), index=response_time.index)
+
+
+@stage
+def build_response_time_sketches(msg_df):
+    # One row per (day, chat, direction, bucket) with the number of replies, sorted by datetime like the cube
+    frame = pd.DataFrame({key: msg_df[key] for key in CUBE_KEYS})
+    frame['datetime'] = msg_df['datetime'].dt.floor('D')
+    frame['bucket'] = response_time_buckets(msg_df['response_time'])
+    frame = frame[frame['bucket'] >= 0]
+
+    sketches = frame.groupby(CUBE_KEYS + ['bucket'], observed=True).size().astype('int32').rename('count')
+    return sketches.reset_index().sort_values('datetime', kind='stable', ignore_index=True)
+
+
+def sum_sketches(sketches):
+    # Sketches of disjoint messages (the parts of msg_store) added up into one, rows as in build_response_time_sketches
+    sketches = pd.concat(sketches, ignore_index=True)
+    sketches = sketches.groupby(CUBE_KEYS + ['bucket'], observed=True)['count'].sum().astype('int32')
+    return sketches.reset_index().sort_values('datetime', kind='stable', ignore_index=True)
+
+
+def merge_sketches(sketches, by=()):
+    # Reply counts per bucket (columns) for every group of by (rows), a single row when by is empty
+    by = list(by)
+    counts = sketches.groupby(by + ['bucket'], observed=True)['count'].sum()
+    if not by:
+        return counts.to_frame().T
+    return counts.unstack('bucket', fill_value=0).sort_index(axis=1)
+
+
+def sketch_quantile(bucket_counts, q=0.5):
+    # Response time (in seconds) below which a fraction q of the replies fall, per row of merge_sketches.
+    # Interpolated log-linearly inside the bucket, NaN for rows without replies.
+    buckets = bucket_counts.columns.to_numpy(dtype='float64')
+    counts = bucket_counts.to_numpy(dtype='float64')
+    if counts.shape[1] == 0:
+        return pd.Series(np.nan, index=bucket_counts.index)
+    cumulative = counts.cumsum(axis=1)
+    target = cumulative[:, -1:] * q
+    position = np.minimum((cumulative < target).sum(axis=1), len(buckets) - 1)
+    rows = np.arange(len(counts))
+    below = np.where(position > 0, cumulative[rows, position - 1], 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = (target[:, 0] - below) / counts[rows, position]
+    seconds = SKETCH_BASE ** (buckets[position] + fraction)
+    return pd.Series(np.where(cumulative[:, -1] > 0, seconds, np.nan), index=bucket_counts.index)
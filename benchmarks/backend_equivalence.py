@@ -0,0 +1,120 @@
+# Checks that every query backend returns what the pandas reference (over the tables msg_store keeps) does, on
+# synthetic exports: the same cube, sketch and rollup rows for each dashboard filter, and the same figures built
+# from them. A pandas backend built from the parsed message frame ('frame') is checked the same way. Every backend, the
+# reference too, must also count the same messages in the cube and the rollups, and the same replies in the cube
+# and the sketches, over a date range. Exits with status 1 on a mismatch.
+#   python benchmarks/backend_equivalence.py --messages 5000
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import single_plots  # noqa: E402
+from aggregates import RESPONSE_TIME_COLUMNS, ROLLUP_GRANULARITIES, rollup_start  # noqa: E402
+from query_backend import BACKENDS, PandasBackend, open_backend  # noqa: E402
+from run_benchmarks import BUILDERS  # noqa: E402
+from synthetic_exports import synthetic_tables  # noqa: E402
+
+
+def normalized(df):
+    # Backends differ in dtypes (categoricals, integer widths, datetime units), not in values
+    df = df.reset_index(drop=True)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str)
+        elif pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].astype('datetime64[ns]')
+    return df
+
+
+def filters(reference):
+    last = reference.last_datetime()
+    chats = reference.chats()
+    one_dm = chats.loc[chats['chat_type'] == 'dm', 'chat_id'].iloc[0]
+    one_group = chats.loc[chats['chat_type'] == 'group', 'chat_id'].iloc[0]
+    for start in ['2019-01-01', '2021-06-15']:
+        for platforms in [['whatsapp', 'telegram'], ['telegram']]:
+            yield start, last.date(), platforms, 'dm', None
+            yield start, last.date(), platforms, 'group', None
+            yield start, last.date(), platforms, 'dm', one_dm
+            yield start, last.date(), platforms, 'group', one_group
+
+
+def compare(reference, backend):
+    mismatches = []
+    for query in filters(reference):
+        frames = {}
+        for table in ['cube', 'sketches'] + [f'rollup_{granularity}' for granularity in ROLLUP_GRANULARITIES]:
+            expected, actual = reference.query(table, *query), backend.query(table, *query)
+            try:
+                pd.testing.assert_frame_equal(normalized(actual), normalized(expected), check_dtype=False)
+            except AssertionError as error:
+                mismatches.append(f'{table} {query}: {str(error).splitlines()[0]}')
+            frames[table] = expected, actual
+        frames['rollup'] = frames[f'rollup_{single_plots.trend_rollup(query[0], query[1])}']
+        for builder, table in BUILDERS:
+            expected, actual = (getattr(single_plots, builder)(df) for df in frames[table])
+            if expected.to_json() != actual.to_json():
+                mismatches.append(f'{builder} {query}')
+    return mismatches
+
+
+def count_mismatches(backend):
+    # The tables are bucketed by hour, day or period, a date range must still cover the same messages in each. The
+    # rollups are read from the start of the period start falls in, as the dashboard does, over the whole history.
+    last = backend.last_datetime().date()
+    mismatches = []
+    ranges = [('2019-01-01', last, ROLLUP_GRANULARITIES), ('2021-06-15', '2021-09-30', ['day'])]
+    for start, end, granularities in ranges:
+        for chat_type in ['dm', 'group']:
+            query = (['whatsapp', 'telegram'], chat_type)
+            cube = backend.query('cube', start, end, *query)
+            messages = {'cube': int(cube['message_count'].sum())}
+            for granularity in granularities:
+                rollup_from = rollup_start(pd.Series([pd.Timestamp(start)]), granularity).iloc[0]
+                rollup = backend.query(f'rollup_{granularity}', rollup_from, end, *query)
+                messages[f'rollup_{granularity}'] = int(rollup['message_count'].sum())
+            replies = {'cube': int(cube[RESPONSE_TIME_COLUMNS].to_numpy().sum()),
+                       'sketches': int(backend.query('sketches', start, end, *query)['count'].sum())}
+            for counts in [messages, replies]:
+                if len(set(counts.values())) > 1:
+                    mismatches.append(f'counts {start} to {end} {chat_type}: {counts}')
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=8, help='chats per platform')
+    parser.add_argument('--messages', type=int, default=5_000, help='messages per chat')
+    parser.add_argument('--backends', nargs='+', default=[name for name in BACKENDS if name != 'pandas'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        msg_df, _, _ = synthetic_tables(os.path.join(root, 'data'), args.chats, args.chats, args.messages)
+        os.chdir(root)
+        start = time.perf_counter()
+        reference = open_backend('pandas')
+        print(f"pandas: {time.perf_counter() - start:.2f}s")
+        mismatches = count_mismatches(reference)
+        for mismatch in mismatches:
+            print(f"  mismatch {mismatch}")
+        failed = bool(mismatches)
+        for name in ['frame'] + args.backends:
+            start = time.perf_counter()
+            backend = PandasBackend.from_msg_df(msg_df) if name == 'frame' else open_backend(name)
+            print(f"{name}: {time.perf_counter() - start:.2f}s")
+            mismatches = compare(reference, backend) + count_mismatches(backend)
+            for mismatch in mismatches:
+                print(f"  mismatch {mismatch}")
+            print(f"{name}: {'differs from' if mismatches else 'matches'} pandas")
+            failed |= bool(mismatches)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Checks that no single_plots builder writes to the frame it is given: every builder runs on raw, compact, view
+# and empty message frames and on slices of the table the dashboard builds it from, and each input must still
+# equal the copy taken before the call. Exits with status 1 when a builder mutates its input.
+#   python benchmarks/builder_inputs.py --messages 2000
+import argparse
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import single_plots  # noqa: E402
+from run_benchmarks import BUILDERS  # noqa: E402
+from synthetic_exports import synthetic_tables  # noqa: E402
+
+
+def input_frames(msg_df, compact, tables):
+    # (name, frame) pairs every builder gets, then the table slices of each table name
+    frames = [
+        ('raw', msg_df),
+        ('compact', compact),
+        # Row slices share their blocks with the frame they come from
+        ('raw view', msg_df.iloc[len(msg_df) // 4:len(msg_df) // 2]),
+        ('compact view', compact[compact['chat_type'] == 'dm']),
+        ('raw empty', msg_df.iloc[:0]),
+        ('compact empty', compact.iloc[:0]),
+    ]
+    table_frames = {table: [(f'{table} slice', df.iloc[len(df) // 3:]), (f'{table} empty', df.iloc[:0])]
+                    for table, df in tables.items()}
+    return frames, table_frames
+
+
+def check(builder, name, frame):
+    before = frame.copy(deep=True)
+    try:
+        getattr(single_plots, builder)(frame)
+    except Exception as error:
+        return f'{builder} on {name} raised {type(error).__name__}: {error}'
+    try:
+        pd.testing.assert_frame_equal(frame, before)
+    except AssertionError as error:
+        return f'{builder} changed its {name} input: {str(error).splitlines()[0]}'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=4, help='chats per platform')
+    parser.add_argument('--messages', type=int, default=2_000, help='messages per chat')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        msg_df, compact, tables = synthetic_tables(root, args.chats, args.chats, args.messages, 'week')
+    frames, table_frames = input_frames(msg_df, compact, tables)
+
+    failures = []
+    for builder, table in BUILDERS:
+        for name, frame in frames + table_frames[table]:
+            failure = check(builder, name, frame)
+            if failure:
+                failures.append(failure)
+                print(failure)
+    if failures:
+        sys.exit(1)
+    print(f"{len(BUILDERS)} builders leave all {len(frames) + 2} of their inputs unchanged")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Callback throughput and latency of the production server as the worker count grows.
+#   python benchmarks/load_test.py --workers 1 2 4 --clients 16 --requests 400
+# Run from the directory holding data/ (or pass --data-root). Every request asks for all dashboard figures
+# with a random date range so that the figure cache doesn't answer them, pass --cached to allow it.
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+# Importing the dashboard only defines its app, the data is loaded by the server this test starts
+from dashboard import FIGURE_BUILDERS  # noqa: E402
+
+# The outputs of the figure callback, in its order
+GRAPH_IDS = list(FIGURE_BUILDERS)
+
+
+def callback_payload(start_date, end_date, pathname):
+    return {
+        'output': '..' + '...'.join(f'{graph_id}.figure' for graph_id in GRAPH_IDS) + '..',
+        'outputs': [{'id': graph_id, 'property': 'figure'} for graph_id in GRAPH_IDS],
+        'inputs': [
+            {'id': 'date_picker', 'property': 'start_date', 'value': start_date},
+            {'id': 'date_picker', 'property': 'end_date', 'value': end_date},
+            {'id': 'platform_checklist', 'property': 'value', 'value': ['whatsapp', 'telegram']},
+            {'id': 'url', 'property': 'pathname', 'value': pathname},
+            {'id': 'chat_dropdown', 'property': 'value', 'value': None},
+        ],
+        'changedPropIds': ['date_picker.start_date'],
+        'state': [],
+    }
+
+
+def post(url, payload):
+    request = urllib.request.Request(url + '/_dash-update-component', data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=120) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def wait_until_ready(url, process, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            with urllib.request.urlopen(url + '/ready', timeout=5):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError('server did not start')
+
+
+def run(workers, args):
+    port = args.port + workers
+    url = f'http://127.0.0.1:{port}'
+    process = subprocess.Popen([sys.executable, os.path.join(REPO, 'serve.py'), '--workers', str(workers),
+                                '--bind', f'127.0.0.1:{port}'], cwd=args.data_root,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, process)
+        rng = random.Random(workers)
+        payloads = []
+        for _ in range(args.requests):
+            start_date = '2024-01-01' if args.cached else f'20{rng.randint(15, 23)}-{rng.randint(1, 12):02d}-01'
+            payloads.append(callback_payload(start_date, '2030-12-31', rng.choice(['/dms', '/groups'])))
+        # One warm-up request per worker so imports and first renders aren't measured
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda payload: post(url, payload), payloads[:workers]))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            latencies = np.array(list(executor.map(lambda payload: post(url, payload), payloads)))
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'workers': workers,
+        'requests_per_s': len(latencies) / elapsed,
+        'p50_ms': np.percentile(latencies, 50) * 1000,
+        'p95_ms': np.percentile(latencies, 95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=18050)
+    parser.add_argument('--data-root', default=os.getcwd())
+    parser.add_argument('--cached', action='store_true')
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for workers in args.workers:
+        result = run(workers, args)
+        print(f"{result['workers']:>8} {result['requests_per_s']:>8.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Memory of the combined message table before and after compact_msg_df on a synthetic dataset.
+#   python benchmarks/memory_report.py --messages 10000000
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from io_utils import compact_msg_df  # noqa: E402
+
+
+def synthetic_msg_df(n_messages, n_chats=2_000, n_people=5_000, seed=0):
+    # Same columns and dtypes as msg2df, values drawn at random
+    rng = np.random.default_rng(seed)
+    words = np.array(['hey', 'ok', 'see', 'you', 'tomorrow', 'haha', 'what', 'time', 'lunch', 'sure'], dtype=object)
+    chat = rng.integers(0, n_chats, n_messages)
+    platform = np.where(chat % 3 == 0, 'whatsapp', 'telegram').astype(object)
+    datetimes = pd.to_datetime(rng.integers(1.4e9, 1.73e9, n_messages), unit='s')
+    word_count = rng.integers(1, 20, n_messages)
+    person = rng.integers(0, n_people, n_messages)
+    bodies = np.array([' '.join(words[:k % 10 + 1]) * (k // 10 + 1) for k in range(20)], dtype=object)
+    msg_df = pd.DataFrame({
+        'datetime': datetimes,
+        'day_of_the_week': datetimes.day_name(),
+        'platform': platform,
+        'chat_name': np.char.add('Chat ', chat.astype(str)).astype(object),
+        'chat_id': np.where(platform == 'whatsapp', chat, chat + 10 ** 9),
+        'chat_type': np.where(chat % 5 == 0, 'group', 'dm').astype(object),
+        'person_name': np.char.add('Person ', person.astype(str)).astype(object),
+        'person_id': np.char.add('user', person.astype(str)).astype(object),
+        'msg_type': rng.choice(np.array(['text', 'audio/ogg', 'video/mp4', 'image'], dtype=object), n_messages,
+                               p=[0.9, 0.04, 0.03, 0.03]),
+        'has_link': rng.random(n_messages) < 0.02,
+        'has_emoji': rng.random(n_messages) < 0.05,
+        'msg_content': bodies[word_count],
+        'word_count': word_count,
+        'char_count': np.array([len(body) for body in bodies])[word_count],
+    })
+    msg_df['sent'] = person == 0
+    msg_df['received'] = ~msg_df['sent']
+    msg_df['response_time'] = pd.to_timedelta(rng.exponential(600, n_messages).astype('int64'), unit='s')
+    return msg_df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    before = synthetic_msg_df(args.messages)
+    before_usage = before.memory_usage(deep=True, index=False)
+    after_usage = compact_msg_df(before).memory_usage(deep=True, index=False)
+
+    report = pd.DataFrame({'before_mb': before_usage, 'after_mb': after_usage}) / 2 ** 20
+    report.loc['total'] = report.sum()
+    print(f"{args.messages:,} messages")
+    print(report.round(1).fillna('-').to_string())
+    print(f"compact table is {report.loc['total', 'after_mb'] / report.loc['total', 'before_mb']:.1%} of the original")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Checks that every dashboard figure stays under a JSON byte budget however long the history is: each builder
+# runs on synthetic exports of growing size and the run fails (exit status 1) when a figure exceeds the budget.
+#   python benchmarks/payload_budget.py --messages 2000 20000
+import argparse
+import os
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import single_plots  # noqa: E402
+from run_benchmarks import BUILDERS  # noqa: E402
+from synthetic_exports import synthetic_tables  # noqa: E402
+
+FIGURE_BYTE_BUDGET = 16 * 1024
+
+
+def figure_sizes(whatsapp_chats, telegram_chats, messages):
+    # Of every rollup, the day one over the whole history is the largest a trend figure is ever given
+    with tempfile.TemporaryDirectory() as root:
+        msg_df, _, tables = synthetic_tables(root, whatsapp_chats, telegram_chats, messages, 'day')
+    sizes = {builder: len(getattr(single_plots, builder)(tables[table]).to_json()) for builder, table in BUILDERS}
+    return len(msg_df), sizes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, nargs='+', default=[1_000, 10_000, 40_000],
+                        help='messages per chat, one run per value')
+    parser.add_argument('--chats', type=int, default=10, help='chats per platform')
+    parser.add_argument('--budget', type=int, default=FIGURE_BYTE_BUDGET)
+    args = parser.parse_args()
+
+    runs = [figure_sizes(args.chats, args.chats, messages) for messages in args.messages]
+    print(f"{'figure':>32}" + ''.join(f"{n_messages:>12,}" for n_messages, _ in runs))
+    over = []
+    for builder, _ in BUILDERS:
+        sizes = [run_sizes[builder] for _, run_sizes in runs]
+        print(f"{builder:>32}" + ''.join(f"{size:>12,}" for size in sizes))
+        if max(sizes) > args.budget:
+            over.append(builder)
+    if over:
+        print(f"over the {args.budget:,} byte budget: {', '.join(over)}")
+        sys.exit(1)
+    print(f"every figure is under {args.budget:,} bytes")
+
+
+if __name__ == '__main__':
+    main()
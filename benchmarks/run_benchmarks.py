@@ -0,0 +1,174 @@
+# Per-stage timings, throughput and peak RSS of the whole pipeline on synthetic exports: ingest, the tables the
+# dashboard keeps, the dashboard filters and every figure builder. Each run is appended to a results file and
+# compared with the previous run of the same size.
+#   python benchmarks/run_benchmarks.py --whatsapp-chats 20 --telegram-chats 20 --messages 50000
+#   python benchmarks/run_benchmarks.py --data-root data    # real exports instead of synthetic ones
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import single_plots  # noqa: E402
+from aggregates import build_message_cube, build_response_time_sketches, build_rollup  # noqa: E402
+# Importing the dashboard only defines its app, nothing is loaded
+from dashboard import FIGURE_BUILDERS  # noqa: E402
+from io_utils import whatsapp2df, telegram2df, combine_msg_dfs, compact_msg_df  # noqa: E402
+from msg_index import MessageIndex  # noqa: E402
+from synthetic_exports import generate_exports  # noqa: E402
+
+RESULTS = os.path.join(REPO, 'benchmarks', 'results', 'results.jsonl')
+# The dashboard's figures and the table each is built from, plus the message count distribution of its own callback
+BUILDERS = list(FIGURE_BUILDERS.values()) + [('message_count_distplot', 'cube')]
+# (name, chat type, chat) as picked in the dashboard, the date range is the whole dataset
+FILTERS = [('all dms', 'dm', False), ('all groups', 'group', False), ('one chat', 'dm', True)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Stages:
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, function, *args, rows_in=None):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            'seconds': seconds,
+            'rows_in': rows_in,
+            'rows_out': len(result) if hasattr(result, '__len__') else None,
+            'rows_per_s': rows_in / seconds if rows_in and seconds else None,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline(telegram_file, whatsapp_folder):
+    stages = Stages()
+    whatsapp_df = stages.run('whatsapp2df', whatsapp2df, whatsapp_folder)
+    telegram_df = stages.run('telegram2df', telegram2df, telegram_file)
+    n_messages = len(whatsapp_df) + len(telegram_df)
+    # The ingest stages report messages per second on their output
+    for name, df in [('whatsapp2df', whatsapp_df), ('telegram2df', telegram_df)]:
+        stages.results[name]['rows_per_s'] = len(df) / stages.results[name]['seconds']
+    msg_df = stages.run('combine_msg_dfs', combine_msg_dfs, telegram_df, whatsapp_df, rows_in=n_messages)
+    del whatsapp_df, telegram_df
+
+    compact = stages.run('compact_msg_df', compact_msg_df, msg_df, rows_in=n_messages)
+    del msg_df
+    tables = {
+        'cube': stages.run('build_message_cube', build_message_cube, compact, rows_in=n_messages),
+        'sketches': stages.run('build_response_time_sketches', build_response_time_sketches, compact,
+                               rows_in=n_messages),
+        # The rollup the trend figure reads for the whole date range
+        'rollup': stages.run('build_rollup', build_rollup, compact,
+                             single_plots.trend_rollup(compact['datetime'].min(), compact['datetime'].max()),
+                             rows_in=n_messages),
+    }
+    del compact
+    indexes = {table: stages.run(f'index {table}', MessageIndex, df, rows_in=len(df)) for table, df in tables.items()}
+
+    cube = tables['cube']
+    start_date, end_date = cube['datetime'].min().date(), cube['datetime'].max().date()
+    platforms = ['whatsapp', 'telegram']
+    busiest_dm = cube[cube['chat_type'] == 'dm'].groupby('chat_id', observed=True)['message_count'].sum().idxmax()
+    for name, chat_type, one_chat in FILTERS:
+        chat_id = busiest_dm if one_chat else None
+        filtered = {table: stages.run(f'filter {table} {name}', index.query, start_date, end_date, platforms,
+                                      chat_type, chat_id, rows_in=len(tables[table]))
+                    for table, index in indexes.items()}
+        for builder, table in BUILDERS:
+            stages.run(f'{builder} {name}', getattr(single_plots, builder), filtered[table],
+                       rows_in=len(filtered[table]))
+    return n_messages, stages.results
+
+
+def compare(previous, current):
+    print(f"\ncompared with {previous['commit']} ({previous['timestamp']})")
+    print(f"{'stage':>50} {'before s':>9} {'after s':>9} {'change':>8}")
+    for name, result in current['stages'].items():
+        before = previous['stages'].get(name)
+        if before is None or not before['seconds']:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        flag = '  <-- slower' if change > 0.2 and result['seconds'] - before['seconds'] > 0.01 else ''
+        print(f"{name:>50} {before['seconds']:>9.3f} {result['seconds']:>9.3f} {change:>+8.0%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--whatsapp-chats', type=int, default=10)
+    parser.add_argument('--telegram-chats', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20_000, help='messages per chat')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-root', help='folder holding telegram.json and whatsapp/, instead of synthetic data')
+    parser.add_argument('--results', default=RESULTS)
+    parser.add_argument('--label', default='', help='stored with the results, e.g. a branch name')
+    args = parser.parse_args()
+
+    if args.data_root:
+        params = {'data_root': os.path.abspath(args.data_root)}
+        n_messages, results = run_pipeline(os.path.join(args.data_root, 'telegram.json'),
+                                           os.path.join(args.data_root, 'whatsapp'))
+    else:
+        params = {'whatsapp_chats': args.whatsapp_chats, 'telegram_chats': args.telegram_chats,
+                  'messages': args.messages, 'seed': args.seed}
+        with tempfile.TemporaryDirectory() as root:
+            start = time.perf_counter()
+            telegram_file, whatsapp_folder = generate_exports(root, args.whatsapp_chats, args.telegram_chats,
+                                                              args.messages, args.seed)
+            print(f"generated exports in {time.perf_counter() - start:.1f}s")
+            n_messages, results = run_pipeline(telegram_file, whatsapp_folder)
+
+    print(f"{n_messages:,} messages, peak RSS {peak_rss_mb():,.0f} MB")
+    print(f"{'stage':>50} {'seconds':>9} {'rows in':>10} {'rows out':>10} {'rows/s':>12} {'peak MB':>8}")
+    for name, result in results.items():
+        print(f"{name:>50} {result['seconds']:>9.3f} {result['rows_in'] or '':>10} {result['rows_out'] or '':>10} "
+              f"{format(result['rows_per_s'], ',.0f') if result['rows_per_s'] else '':>12} "
+              f"{result['peak_rss_mb']:>8.0f}")
+
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'label': args.label,
+        'python': sys.version.split()[0],
+        'params': params,
+        'messages': n_messages,
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': results,
+    }
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results) as file:
+            runs = [json.loads(line) for line in file if line.strip()]
+        previous = next((run for run in reversed(runs) if run['params'] == params), None)
+    if previous:
+        compare(previous, record)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    print(f"\nresults appended to {args.results}")
+
+
+if __name__ == '__main__':
+    main()
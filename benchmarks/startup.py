@@ -0,0 +1,72 @@
+# Time from launching the dashboard until it serves the page shell, and until the data is loaded.
+#   python benchmarks/startup.py --runs 3
+# Run from the directory holding data/ (or pass --data-root).
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(data_root):
+    # Import only, in a fresh interpreter
+    code = 'import time; start = time.perf_counter(); import dashboard; print(time.perf_counter() - start)'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=data_root,
+                                     env=dict(os.environ, PYTHONPATH=REPO))
+    return float(output.decode().split()[-1])
+
+
+def wait_for(url, process, start, timeout=600):
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return time.perf_counter() - start
+        except (urllib.error.HTTPError, OSError):
+            time.sleep(0.05)
+    raise TimeoutError(f'{url} did not respond')
+
+
+def run(port, data_root):
+    url = f'http://127.0.0.1:{port}'
+    code = f'import dashboard; dashboard.start_loader(); dashboard.app.run_server(port={port})'
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=data_root, env=dict(os.environ, PYTHONPATH=REPO),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        page = wait_for(url + '/', process, start)
+        ready = wait_for(url + '/ready', process, start)
+    finally:
+        process.terminate()
+        process.wait()
+    return page, ready
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--port', type=int, default=18150)
+    parser.add_argument('--data-root', default=os.getcwd())
+    args = parser.parse_args()
+
+    imports, pages, readies = [], [], []
+    for i in range(args.runs):
+        imports.append(import_time(args.data_root))
+        page, ready = run(args.port + i, args.data_root)
+        pages.append(page)
+        readies.append(ready)
+
+    print(f"{'stage':>12} {'median s':>9} {'max s':>9}")
+    for stage, times in [('import', imports), ('page served', pages), ('data ready', readies)]:
+        print(f"{stage:>12} {np.median(times):>9.2f} {np.max(times):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
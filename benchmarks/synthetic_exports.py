@@ -0,0 +1,147 @@
+# Writes synthetic chat exports in the layout msg2df reads: data/whatsapp/WhatsApp Chat - <name>.zip archives and
+# a Telegram data/telegram.json export (Telegram names it result.json, rename real exports the same way).
+#   python benchmarks/synthetic_exports.py /tmp/bench --whatsapp-chats 20 --telegram-chats 20 --messages 50000
+import argparse
+import json
+import os
+import random
+import zipfile
+from datetime import datetime as dt, timedelta
+
+WORDS = ['hey', 'ok', 'see', 'you', 'tomorrow', 'haha', 'what', 'time', 'lunch', 'sure', 'yes', 'no', 'maybe',
+         'where', 'are', 'coming', 'tonight', 'call', 'me', 'later', 'love', 'this', 'sounds', 'good']
+LINKS = ['https://example.com/article', 'https://youtu.be/dQw4w9WgXcQ', 'https://maps.app.goo.gl/xyz']
+OWNER = 'Kais'
+
+
+def _timestamps(n_messages, rng, start=dt(2020, 1, 1)):
+    # Bursts of quick back-and-forth separated by hours or days of silence
+    timestamp = start
+    for _ in range(n_messages):
+        timestamp += timedelta(seconds=rng.randint(1, 120) if rng.random() < 0.8 else rng.randint(600, 3 * 86400))
+        yield timestamp
+
+
+def _speakers(participants, rng):
+    # Runs of messages from the same person before someone answers
+    speaker = rng.choice(participants)
+    while True:
+        yield speaker
+        if rng.random() < 0.4:
+            speaker = rng.choice(participants)
+
+
+def _text(rng):
+    return ' '.join(rng.choices(WORDS, k=rng.randint(1, 12)))
+
+
+def write_whatsapp_chat(folder, chat_name, n_messages, participants, rng):
+    # A _chat.txt as exported by WhatsApp on iOS: bracketed timestamps, \r\n line ends, multi-line messages,
+    # media placeholders and the invisible marks WhatsApp puts around them
+    lines = [f"[01.01.20, 00:00:00] {chat_name}: \u200eMessages and calls are end-to-end encrypted. "
+             f"No one outside of this chat, not even WhatsApp, can read or listen to them."]
+    for timestamp, speaker in zip(_timestamps(n_messages, rng), _speakers(participants, rng)):
+        roll = rng.random()
+        if roll < 0.05:
+            body = '\u200e' + rng.choice(['audio omitted', 'image omitted', 'video omitted'])
+        elif roll < 0.08:
+            body = _text(rng) + '\n' + _text(rng)
+        elif roll < 0.10:
+            body = _text(rng) + ' ' + rng.choice(LINKS)
+        else:
+            body = _text(rng)
+        lines.append(f"[{timestamp:%d.%m.%y, %H:%M:%S}] {speaker}: {body}")
+    path = os.path.join(folder, f'WhatsApp Chat - {chat_name}.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('_chat.txt', '\r\n'.join(lines) + '\r\n')
+    return path
+
+
+def _telegram_messages(n_messages, participants, rng):
+    for message_id, (timestamp, speaker) in enumerate(zip(_timestamps(n_messages, rng), _speakers(participants, rng))):
+        roll = rng.random()
+        if roll < 0.02:
+            # Service messages (calls, pins, joins) are skipped by the parser
+            yield {'id': message_id, 'type': 'service', 'date': timestamp.isoformat(), 'actor': speaker,
+                   'actor_id': f'user{participants.index(speaker) + 1}', 'action': 'phone_call', 'text': ''}
+            continue
+        message = {'id': message_id, 'type': 'message', 'date': timestamp.isoformat(), 'from': speaker,
+                   'from_id': f'user{participants.index(speaker) + 1}', 'text': _text(rng)}
+        if roll < 0.06:
+            message['mime_type'] = rng.choice(['audio/ogg', 'video/mp4'])
+            message['text'] = ''
+        elif roll < 0.09:
+            link = rng.choice(LINKS)
+            message['text'] = [_text(rng) + ' ', {'type': 'link', 'text': link}]
+        yield message
+
+
+def write_telegram_export(path, n_chats, n_messages, rng):
+    # A full export (Settings > Advanced > Export Telegram data, JSON) holding n_chats chats
+    chats = []
+    for i in range(n_chats):
+        group = i % 4 == 0
+        participants = [OWNER, f'TG Friend {i}'] + ([f'TG Other {i}', f'TG Third {i}'] if group else [])
+        chats.append({
+            'name': f'TG Chat {i}',
+            'type': 'private_group' if group else 'personal_chat',
+            'id': 4_000_000_000 + i,
+            'messages': list(_telegram_messages(n_messages, participants, rng)),
+        })
+    export = {
+        'about': 'Here is the data you requested.',
+        'personal_information': {'user_id': 1, 'first_name': OWNER, 'phone_number': '+0 000 000 0000'},
+        'chats': {'about': 'This is the list of all chats.', 'list': chats},
+        'left_chats': {'about': 'This is the list of chats you left.', 'list': []},
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(export, file, ensure_ascii=False, indent=1)
+    return path
+
+
+def generate_exports(root, whatsapp_chats=10, telegram_chats=10, messages=10_000, seed=0):
+    # Returns the telegram file and whatsapp folder to pass to msg2df
+    rng = random.Random(seed)
+    whatsapp_folder = os.path.join(root, 'whatsapp')
+    os.makedirs(whatsapp_folder, exist_ok=True)
+    for i in range(whatsapp_chats):
+        participants = [OWNER, f'Friend {i}'] + ([f'Other {i}'] if i % 3 == 0 else [])
+        write_whatsapp_chat(whatsapp_folder, f'Chat {i}', messages, participants, rng)
+    telegram_file = write_telegram_export(os.path.join(root, 'telegram.json'), telegram_chats, messages, rng)
+    return telegram_file, whatsapp_folder
+
+
+def synthetic_tables(root, whatsapp_chats=10, telegram_chats=10, messages=10_000, granularity='day', seed=0):
+    # Exports generated under root, parsed into the combined message frame, its compact form and the tables the
+    # dashboard builds its figures from (the trend rollup at granularity). The repository must be on sys.path.
+    from aggregates import build_message_cube, build_response_time_sketches, build_rollup
+    from io_utils import whatsapp2df, telegram2df, combine_msg_dfs, compact_msg_df
+
+    telegram_file, whatsapp_folder = generate_exports(root, whatsapp_chats, telegram_chats, messages, seed)
+    msg_df = combine_msg_dfs(telegram2df(telegram_file), whatsapp2df(whatsapp_folder))
+    compact = compact_msg_df(msg_df)
+    tables = {
+        'cube': build_message_cube(compact),
+        'sketches': build_response_time_sketches(compact),
+        'rollup': build_rollup(compact, granularity),
+    }
+    return msg_df, compact, tables
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help='directory to write to, e.g. data')
+    parser.add_argument('--whatsapp-chats', type=int, default=10)
+    parser.add_argument('--telegram-chats', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10_000, help='messages per chat')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    telegram_file, whatsapp_folder = generate_exports(args.root, args.whatsapp_chats, args.telegram_chats,
+                                                      args.messages, args.seed)
+    print(telegram_file)
+    print(whatsapp_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Compares the vectorized WhatsApp parser against the original per-line loop on synthetic exports.
+#   python benchmarks/whatsapp_parser.py --chats 20 --messages 50000
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime as dt, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from io_utils import whatsapp2df  # noqa: E402
+
+
+def legacy_whatsapp2df(folder_path):
+    # The per-line loop io_utils.whatsapp2df used before the vectorized engine, kept as the baseline
+    data = []
+    weird_chars = ['\u202a', '\u202c', '\xa0', '\u200e', '\u202f']
+    chat_id_counter = 0
+    for file_name in sorted(os.listdir(folder_path)):
+        if file_name.endswith('.zip') and file_name.startswith('WhatsApp Chat - '):
+            chat_name = file_name[16:-4]
+            chat_id_counter += 1
+            with zipfile.ZipFile(os.path.join(folder_path, file_name), 'r') as zip_ref:
+                for inner_file in zip_ref.namelist():
+                    if inner_file.endswith('_chat.txt'):
+                        with zip_ref.open(inner_file) as f:
+                            content = f.read().decode('utf-8')
+                            content = content.translate(str.maketrans('', '', ''.join(weird_chars)))
+                            for line in content.split('\r\n'):
+                                if "Messages and calls are end-to-end encrypted. No one outside of this chat" in line:
+                                    continue
+                                match = re.match(r'\[(\d{2}\.\d{2}\.\d{2}), (\d{2}:\d{2}:\d{2})\] (.*?): (.*)', line)
+                                if match:
+                                    date_str, time_str, person_name, msg_content = match.groups()
+                                    datetime_obj = dt.strptime(f"{date_str} {time_str}", '%d.%m.%y %H:%M:%S')
+                                    day_of_the_week = datetime_obj.strftime('%A')
+                                    if msg_content == "audio omitted":
+                                        msg_type = "audio"
+                                    elif msg_content == "image omitted":
+                                        msg_type = "image"
+                                    elif msg_content == "video omitted":
+                                        msg_type = "video"
+                                    else:
+                                        msg_type = "text"
+                                    word_count = len(msg_content.split())
+                                    data.append([datetime_obj, day_of_the_week, chat_name, chat_id_counter, person_name,
+                                                 msg_type, msg_content, word_count])
+
+    df = pd.DataFrame(data, columns=['datetime', 'day_of_the_week', 'chat_name', 'chat_id', 'person_name', 'msg_type',
+                                     'msg_content', 'word_count'])
+    df.insert(2, 'platform', 'whatsapp')
+    chats_participant_count = df.groupby('chat_name')['person_name'].nunique()
+    df['chat_type'] = df['chat_name'].apply(lambda x: 'group' if chats_participant_count[x] > 2 else 'dm')
+    df.insert(4, 'chat_type', df.pop('chat_type'))
+    return df
+
+
+def write_chat(folder, chat_name, n_messages, participants, rng):
+    words = ['hey', 'ok', 'see', 'you', 'tomorrow', 'haha', 'what', 'time', 'lunch', 'sure', 'yes', 'no', 'maybe']
+    lines = [f"[01.01.20, 00:00:00] {chat_name}: ‎Messages and calls are end-to-end encrypted. "
+             f"No one outside of this chat, not even WhatsApp, can read or listen to them."]
+    timestamp = dt(2020, 1, 1)
+    for _ in range(n_messages):
+        timestamp += timedelta(seconds=rng.randint(1, 3600))
+        body = rng.choice(['audio omitted', 'image omitted'] if rng.random() < 0.05 else
+                          [' '.join(rng.choices(words, k=rng.randint(1, 12)))])
+        lines.append(f"[{timestamp:%d.%m.%y, %H:%M:%S}] {rng.choice(participants)}: {body}")
+    path = os.path.join(folder, f'WhatsApp Chat - {chat_name}.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('_chat.txt', '\r\n'.join(lines) + '\r\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50_000, help='messages per chat')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        for i in range(args.chats):
+            participants = ['Kais', f'Friend {i}'] + ([f'Other {i}'] if i % 3 == 0 else [])
+            write_chat(folder, f'Chat {i}', args.messages, participants, rng)
+
+        results = {}
+        for name, parse in [('legacy loop', legacy_whatsapp2df), ('vectorized', whatsapp2df)]:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                df = parse(folder)
+                timings.append(time.perf_counter() - start)
+            results[name] = df
+            best = min(timings)
+            print(f"{name:>12}: {best:8.3f}s  {len(df) / best:12,.0f} msgs/s")
+
+        legacy = results['legacy loop']
+        pd.testing.assert_frame_equal(legacy, results['vectorized'][legacy.columns], check_dtype=False)
+        print("outputs match")
+
+
+if __name__ == '__main__':
+    main()
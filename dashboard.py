@@ -1,202 +1,520 @@
-from io_utils import msg2df
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-import plotly.io as pio
-import plotly.graph_objects as go
-from single_plots import (weekday_histogram, hourly_lineplot, messages_per_platform_histogram, response_time_distplot,
-                          message_count_distplot, top_10_message_count, word_count_sent_received)
 import datetime as dt
-import pandas as pd
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import instrumentation
+from instrumentation import stage, profiled, measure
+
+# pandas, plotly, scipy and the data modules are only imported by load_data and build_figures, so the
+# server binds right away while the messages load in the background
+
+logger = logging.getLogger(__name__)
 
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SOLAR], suppress_callback_exceptions=True)
+server = app.server
+
+# Filled in by load_data
+users = None
+data_ready = threading.Event()
+# user -> snapshot of the user's data being served, loaded on the user's first visit and replaced whole by the
+# refresher. Callbacks take a snapshot once and use it throughout, so a swap landing mid-callback never mixes
+# two versions.
+snapshots = {}
+snapshots_lock = threading.Lock()
+# user -> thread loading the user's first snapshot, started by the user's first visit. Loading ingests the user's
+# exports, so it runs in the background while the visit is served the loading page.
+snapshot_loaders = {}
+
+DEFAULT_START_DATE = dt.date(2024, 1, 1)
+# Rows of cube, sketches and rollups the per-year pandas backends of a snapshot hold before the least recently
+# used year is dropped
+MAX_BACKEND_ROWS = 10_000_000
+CHAT_TYPES = {'/dms': 'dm', '/groups': 'group'}
+# Only the default views warmed at load are written to disk, set to 1 to persist every rendered figure too (at
+# most FigureCache.max_files per user)
+PERSIST_FIGURES_ENV = 'TEXTINGWRAPPED_PERSIST_FIGURES'
+
+def load_data():
+    global users
+    import os
+    from msg_store import REFRESH_INTERVAL_ENV, DEFAULT_REFRESH_INTERVAL
+    from users import load_users
+
+    start = time.perf_counter()
+    users = load_users()
+    snapshot = load_user(next(iter(users)))
+    data_ready.set()
+    logger.info("messages of %s loaded in %.1f s", snapshot['user'], time.perf_counter() - start)
+
+    warm_figure_cache(snapshot)
+    interval = float(os.environ.get(REFRESH_INTERVAL_ENV, DEFAULT_REFRESH_INTERVAL))
+    if interval > 0:
+        refresh_loop(interval)
+
+def parse_path(pathname):
+    # (user, page) of a URL, '/dms' is the page of the first user and '/<user>/dms' that of any user.
+    # (None, None) for an unknown user.
+    segments = [segment for segment in (pathname or '/').split('/') if segment]
+    user = next(iter(users))
+    if segments and segments[0] in users:
+        user = segments.pop(0)
+    elif segments and segments[0] not in ['dms', 'groups', 'facts']:
+        return None, None
+    return user, '/' + (segments[0] if segments else 'dms')
+
+def load_snapshot(user, ingest=True):
+    # Everything a user's pages are served from: the stored table as of now (see msg_store.store_snapshot), the
+    # chat list, the figure cache of this version and the query backends opened over it
+    import os
+    import pandas as pd
+    from figure_cache import FigureCache
+    from aggregates import ROLLUP_GRANULARITIES
+    from msg_store import (load_user_msg_df, map_shared_table, shared_version, store_snapshot, SHARED_CUBE_ENV,
+                           SHARED_ROLLUPS_ENV, SHARED_SKETCHES_ENV)
+    from query_backend import PandasBackend
+
+    config = users[user]
+    shared = os.environ.get(SHARED_CUBE_ENV)
+    if ingest and not shared:
+        # Ingest newer exports, the partitions themselves are only read by the backends
+        load_user_msg_df(config, read=False)
+    store = store_snapshot(config['cache_dir'])
+    snapshot = {'user': user, 'store': store, 'version': store['version'], 'backends': OrderedDict(),
+                'backends_lock': threading.Lock()}
+    if shared and os.path.exists(shared.format(user=user)):
+        # Under serve.py the tables of every user are published as Feather files that every worker memory-maps,
+        # mapped once per snapshot they serve any range
+        snapshot['version'] = shared_version(shared.format(user=user)) or store['version']
+        snapshot['backends'][None] = PandasBackend(
+            map_shared_table(shared.format(user=user)),
+            map_shared_table(os.environ[SHARED_SKETCHES_ENV].format(user=user)),
+            {granularity: map_shared_table(os.environ[SHARED_ROLLUPS_ENV].format(user=user, granularity=granularity))
+             for granularity in ROLLUP_GRANULARITIES})
+
+    chats = store['chats'].astype({'chat_name': str, 'platform': str, 'chat_type': str})
+    chats['display_name'] = chats['chat_name'] + ' - ' + chats['platform']
+    snapshot['chats'] = pd.concat([
+        chats[chats['display_name'].str[0].str.isalpha()].sort_values(by='display_name'),
+        chats[~chats['display_name'].str[0].str.isalpha()].sort_values(by='display_name')
+    ])
+    snapshot['last_date'] = store['last_datetime'].date() if store['last_datetime'] is not None else None
+
+    # Rendered figures survive across interactions until the message data changes
+    snapshot['figure_cache'] = FigureCache(cache_dir=os.path.join(config['cache_dir'], 'figures'))
+    snapshot['figure_cache'].invalidate(snapshot['version'])
+    return snapshot
+
+def load_user(user):
+    # Loads the first snapshot of user
+    try:
+        snapshot = load_snapshot(user)
+    except Exception:
+        # The next visit starts over
+        with snapshots_lock:
+            snapshot_loaders.pop(user, None)
+        raise
+    with snapshots_lock:
+        snapshots[user] = snapshot
+    # The facts job follows the ingest in the background, /facts shows them once they are stored
+    threading.Thread(target=prepare_facts, args=(snapshot,), daemon=True).start()
+    return snapshot
+
+def get_snapshot(user):
+    # The snapshot of user, None while their first snapshot loads, which the first call starts
+    snapshot = snapshots.get(user)
+    if snapshot is not None:
+        return snapshot
+    with snapshots_lock:
+        if user not in snapshots and user not in snapshot_loaders:
+            snapshot_loaders[user] = threading.Thread(target=load_user, args=(user,), daemon=True)
+            snapshot_loaders[user].start()
+        return snapshots.get(user)
+
+def refresh_user(user):
+    # Ingests newer exports of user and prepares the new snapshot (backend, default figures, facts) off the request
+    # path, then swaps it in. The snapshot being replaced keeps reading its own parts, they are removed by the next
+    # refresh.
+    import os
+    from msg_store import load_user_msg_df, remove_unlisted_parts, shared_version, store_snapshot, SHARED_CUBE_ENV
+
+    config = users[user]
+    current = snapshots[user]
+    shared = os.environ.get(SHARED_CUBE_ENV)
+    if shared:
+        # serve.py ingests and republishes, workers only pick up the published tables
+        version = shared_version(shared.format(user=user))
+    else:
+        remove_unlisted_parts(config['cache_dir'])
+        load_user_msg_df(config, read=False, remove_parts=False)
+        version = store_snapshot(config['cache_dir'])['version']
+    if version is None or version == current['version']:
+        return
+
+    start = time.perf_counter()
+    snapshot = load_snapshot(user, ingest=False)
+    warm_figure_cache(snapshot)
+    prepare_facts(snapshot)
+    with snapshots_lock:
+        snapshots[user] = snapshot
+    logger.info("%s swapped from data version %s to %s, prepared in %.1f s", user, current['version'],
+                snapshot['version'], time.perf_counter() - start)
+
+def refresh_loop(interval):
+    # Looks at the exports of every loaded user each interval seconds, for as long as the process runs
+    while True:
+        time.sleep(interval)
+        for user in list(snapshots):
+            try:
+                refresh_user(user)
+            except Exception:
+                logger.exception("refreshing %s failed, still serving data version %s", user,
+                                 snapshots[user]['version'])
+
+def prepare_facts(snapshot):
+    # Runs the facts job (see facts.py) for the snapshot's data version unless it already ran. Under serve.py the
+    # publisher runs it and workers only read the stored facts.
+    import os
+    from facts import load_facts
+    from msg_store import SHARED_CUBE_ENV
+
+    if os.environ.get(SHARED_CUBE_ENV):
+        return
+    try:
+        snapshot['facts'] = load_facts(users[snapshot['user']], snapshot['store'])
+    except Exception:
+        logger.exception("facts of %s failed for data version %s", snapshot['user'], snapshot['version'])
+
+def get_facts(snapshot):
+    # The stored facts of the snapshot's data version, kept in memory once read. Never computed here: None (and no
+    # facts entry in the snapshot) until the facts job has stored them.
+    from facts import read_facts
 
-# Customizing the plotly template
-custom_colors = {
-    'background': '#073642',
-    'plot_background': '#839496',
-    'text': '#ffffff',
-    'plot_colors': ['#63BBA2', '#81310E', '#E2D5A1', '#0E6A81', '#BCBACE'],  # Example color for plots
+    if 'facts' not in snapshot:
+        stored = read_facts(users[snapshot['user']], snapshot['store']['version'])
+        if stored is None:
+            return None
+        snapshot['facts'] = stored['facts']
+    return snapshot['facts']
+
+def get_backend(snapshot, year=None):
+    # Every figure is built from the hourly cube, the daily response time sketches and the trend rollups, held by
+    # a query backend (see query_backend). A pandas backend holds a single year of the snapshot, read from that
+    # year's partitions only, DuckDB and the shared tables hold every year.
+    from query_backend import open_backend
+
+    # Opened under the lock: concurrent first requests wait for one backend instead of each building the same
+    # DuckDB file
+    backends = snapshot['backends']
+    with snapshot['backends_lock']:
+        if None in backends:
+            return backends[None]
+        if year not in backends:
+            backends[year] = open_backend(user=users[snapshot['user']], years=None if year is None else (year, year),
+                                          snapshot=snapshot['store'])
+            while len(backends) > 1 and sum(sum(len(df) for df in backend.tables.values())
+                                            for backend in backends.values()) > MAX_BACKEND_ROWS:
+                backends.popitem(last=False)
+        backends.move_to_end(year)
+        return backends[year]
+
+def query_snapshot(snapshot, table, start_date, end_date, platforms, chat_type, chat_id):
+    # Rows of table in the date range, a range over several years concatenates the rows of every year's backend
+    import pandas as pd
+    from query_backend import backend_name
+
+    if None in snapshot['backends'] or backend_name() != 'pandas':
+        return get_backend(snapshot).query(table, start_date, end_date, platforms, chat_type, chat_id)
+    # No year after the last message holds any row
+    first, last = pd.Timestamp(start_date).year, min(pd.Timestamp(end_date).year, snapshot['last_date'].year)
+    frames = [get_backend(snapshot, year).query(table, start_date, end_date, platforms, chat_type, chat_id)
+              for year in range(first, max(first, last) + 1)]
+    # Years without rows would only blur the dtypes of the concatenation
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+def chart_page(pathname):
+    # (snapshot, page) of a DM or group page of a user whose messages are loaded and not empty, the figure callbacks
+    # have nothing to do otherwise
+    user, page = parse_path(pathname)
+    if page not in CHAT_TYPES:
+        raise PreventUpdate
+    snapshot = get_snapshot(user)
+    if snapshot is None or snapshot['last_date'] is None:
+        raise PreventUpdate
+    return snapshot, page
+
+@stage
+def filter_dataframe(snapshot, table, start_date, end_date, platforms, page, chat_id):
+    if table == 'rollup':
+        # The trend figure reads the coarsest rollup that still resolves the range, from the start of the period
+        # start_date falls in so that the first period is whole
+        import pandas as pd
+        import single_plots
+        from aggregates import rollup_start
+
+        granularity = single_plots.trend_rollup(start_date, end_date)
+        table = f'rollup_{granularity}'
+        start_date = rollup_start(pd.Series([pd.Timestamp(start_date)]), granularity).iloc[0]
+    return query_snapshot(snapshot, table, start_date, end_date, platforms, CHAT_TYPES[page], chat_id)
+
+# Graph id -> (single_plots builder, table it is built from), the figures of a table are all fed the same
+# filtered frame. 'rollup' is the trend rollup picked for the date range.
+FIGURE_BUILDERS = {
+    'activity_trend_lineplot': ('activity_trend_lineplot', 'rollup'),
+    'weekday_histogram': ('weekday_histogram', 'cube'),
+    'hourly_lineplot': ('hourly_lineplot', 'cube'),
+    'top_10_message_count': ('top_10_message_count', 'cube'),
+    'messages_per_platform_histogram': ('messages_per_platform_histogram', 'cube'),
+    'word_count_sent_received_histogram': ('word_count_sent_received', 'cube'),
+    'response_time_distplot': ('response_time_distplot', 'cube'),
+    'response_time_density_plot': ('response_time_density_plot', 'sketches'),
+    'median_reply_time_lineplot': ('median_reply_time_lineplot', 'sketches'),
 }
-# Create a custom template
-pio.templates["solar_custom"] = go.layout.Template(
-    layout=go.Layout(
-        paper_bgcolor=custom_colors['background'],
-        plot_bgcolor=custom_colors['plot_background'],
-        font=dict(color=custom_colors['text']),
-    ),
-    layout_colorway=custom_colors['plot_colors']
-)
-# Set the custom template as default
-pio.templates.default = "solar_custom"
-
-# Load the data
-msg_df = msg2df()
-unique_chats = msg_df[['chat_name', 'platform', 'chat_id', 'chat_type']].drop_duplicates().dropna()
-unique_chats['display_name'] = unique_chats['chat_name'] + ' - ' + unique_chats['platform']
-unique_chats = pd.concat([
-    unique_chats[unique_chats['display_name'].str[0].str.isalpha()].sort_values(by='display_name'),
-    unique_chats[~unique_chats['display_name'].str[0].str.isalpha()].sort_values(by='display_name')
-])
 
-def filter_dataframe(df, start_date, end_date, platforms, pathname, chat_id):
-    df = df[
-        (df['datetime'] >= start_date) & (df['datetime'] <= end_date) & (df['platform'].isin(platforms))]
-    df = df[df['chat_id'] == chat_id] if chat_id else df
-    if pathname == '/dms' or pathname == '/':
-        return df[df['chat_type'] == 'dm']
-    elif pathname == '/groups':
-        return df[df['chat_type'] == 'group']
+FILTER_INPUTS = [
+    Input('date_picker', 'start_date'),
+    Input('date_picker', 'end_date'),
+    Input('platform_checklist', 'value'),
+    Input('url', 'pathname'),
+    Input('chat_dropdown', 'value')
+]
 
-@app.callback(
-    Output('weekday_histogram', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
-)
-def update_weekday_histogram(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+def build_figures(snapshot, page, start_date, end_date, platforms, chat_id, persist=False):
+    import os
+    import single_plots
+    from figure_cache import normalize_filter_state
 
-    fig = weekday_histogram(filtered_df)
-    return fig
+    # Cached figures are reused, the filter only runs when at least one figure is missing
+    figure_cache = snapshot['figure_cache']
+    filter_state = normalize_filter_state(start_date, end_date, platforms, page, chat_id)
+    figures = {graph_id: figure_cache.get(graph_id, filter_state) for graph_id in FIGURE_BUILDERS}
+    missing = [graph_id for graph_id, fig in figures.items() if fig is None]
+    if not missing:
+        logger.info("all %d figures served from cache", len(figures))
+        return list(figures.values())
 
-@app.callback(
-    Output('hourly_lineplot', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
-)
-def update_hourlyy_histogram(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+    # Every table is filtered once for all the missing figures built from it
+    sharing = {}
+    for graph_id in missing:
+        sharing[FIGURE_BUILDERS[graph_id][1]] = sharing.get(FIGURE_BUILDERS[graph_id][1], 0) + 1
+    filtered, filter_ms = {}, {}
+    for table in sharing:
+        start = time.perf_counter()
+        filtered[table] = filter_dataframe(snapshot, table, start_date, end_date, platforms, page, chat_id)
+        filter_ms[table] = (time.perf_counter() - start) * 1000
 
-    fig = hourly_lineplot(filtered_df)
-    return fig
+    build_ms = {}
+    for graph_id in missing:
+        start = time.perf_counter()
+        builder, table = FIGURE_BUILDERS[graph_id]
+        with measure(f'build {graph_id}', rows_in=len(filtered[table])):
+            figures[graph_id] = getattr(single_plots, builder)(filtered[table])
+        if instrumentation.ENABLED:
+            # Dash serializes the figures once more when it answers, this times the same work
+            with measure(f'serialize {graph_id}'):
+                figures[graph_id].to_json()
+        figure_cache.put(graph_id, filter_state, figures[graph_id],
+                         persist=persist or os.environ.get(PERSIST_FIGURES_ENV) == '1')
+        build_ms[graph_id] = (time.perf_counter() - start) * 1000
 
-@app.callback(
-    Output('message_count_distplot', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
-)
-def update_message_count_distplot(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+    # One filter per figure would have run each table's filter once more for every other figure sharing it
+    saved_ms = sum(filter_ms[table] * (count - 1) for table, count in sharing.items())
+    logger.info("filter %.1f ms over %d tables shared by %d figures (saved %.1f ms vs one filter per figure), "
+                "build %s", sum(filter_ms.values()), len(filtered), len(missing), saved_ms,
+                ', '.join(f'{graph_id} {ms:.1f} ms' for graph_id, ms in build_ms.items()))
+    return list(figures.values())
 
-    fig = message_count_distplot(filtered_df)
-    return fig
+@app.callback([Output(graph_id, 'figure') for graph_id in FIGURE_BUILDERS], FILTER_INPUTS)
+@profiled
+@stage
+def update_figures(start_date, end_date, platforms, pathname, chat_id):
+    if not data_ready.is_set():
+        raise PreventUpdate
+    snapshot, page = chart_page(pathname)
+    return build_figures(snapshot, page, start_date, end_date, platforms, chat_id)
 
-# Define the layout for the app
-app.layout = (html.Div([
-    dcc.Location(id='url', refresh=False),
-    html.Div(id='page-content')
-]))
+def warm_figure_cache(snapshot):
+    # Render the default DM and group views so the first visit is served from the cache, also after a restart
+    if snapshot['last_date'] is None:
+        return
+    for page in CHAT_TYPES:
+        build_figures(snapshot, page, DEFAULT_START_DATE, snapshot['last_date'], ['whatsapp', 'telegram'], None,
+                      persist=True)
 
-@app.callback(
-    Output('top_10_message_count', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
-)
-def update_top_10_message_count(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+loader = None
+loader_lock = threading.Lock()
 
-    fig = top_10_message_count(filtered_df)
-    return fig
+def start_loader():
+    # Loads the data in the background. Only the process serving requests calls it (python dashboard.py, every
+    # serve.py worker, the first request under another WSGI server), never the import: the debug reloader's
+    # watching parent imports this module too, and must not ingest into or refresh the same store.
+    global loader
+    with loader_lock:
+        if loader is None:
+            loader = threading.Thread(target=load_data, daemon=True)
+            loader.start()
 
-# Define the layout for the app
-app.layout = html.Div([
-    dcc.Location(id='url', refresh=False),
-    html.Div(id='page-content')
-])
+@server.before_request
+def ensure_loader():
+    start_loader()
+
+@server.route('/ready')
+def ready():
+    # 200 once the data is loaded and callbacks produce figures, for health checks and benchmarks
+    if data_ready.is_set():
+        return 'ready'
+    return 'loading', 503
+
+@server.route('/data-version')
+def data_versions():
+    # Data version each loaded user is served from, it changes when the refresher swaps in newer exports
+    return {'ready': data_ready.is_set(),
+            'users': {user: snapshot['version'] for user, snapshot in list(snapshots.items())}}
+
+@server.route('/metrics')
+def metrics():
+    # Stage timings of this process, empty unless TEXTINGWRAPPED_PROFILE is set (see instrumentation.py)
+    return instrumentation.snapshot()
 
 @app.callback(
-    Output('messages_per_platform_histogram', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
+    Output('message_count_distplot', 'figure'),
+    FILTER_INPUTS
 )
-def update_messages_per_platform_histogram(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+@profiled
+@stage
+def update_message_count_distplot(start_date, end_date, platforms, pathname, chat_id):
+    from single_plots import message_count_distplot
+    if not data_ready.is_set():
+        raise PreventUpdate
+    snapshot, page = chart_page(pathname)
+    filtered_df = filter_dataframe(snapshot, 'cube', start_date, end_date, platforms, page, chat_id)
 
-    fig = messages_per_platform_histogram(filtered_df)
+    fig = message_count_distplot(filtered_df)
     return fig
 
 # Define the layout for the app
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
+    # Polls until the data is loaded, then display_page disables it
+    dcc.Interval(id='loading_poll', interval=500),
     html.Div(id='page-content')
 ])
 
-@app.callback(
-    Output('word_count_sent_received_histogram', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
-    ]
-)
-def update_word_count_sent_received(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    for unit, size in [('day', 86400), ('hr', 3600), ('min', 60)]:
+        if seconds >= size:
+            return f"{seconds / size:.1f} {unit}s"
+    return f"{seconds:.0f} secs"
 
-    fig = word_count_sent_received(filtered_df)
-    return fig
+def fact_card(title, value, detail):
+    return dbc.Col([
+        dbc.Card(
+            dbc.CardBody([
+                html.H6(title),
+                html.H3(value),
+                html.P(detail),
+            ])
+        )
+    ], width=4)
 
-@app.callback(
-    Output('response_time_distplot', 'figure'),
-    [Input('date_picker', 'start_date'),
-     Input('date_picker', 'end_date'),
-     Input('platform_checklist', 'value'),
-     Input('url', 'pathname'),
-     Input('chat_dropdown', 'value')
+def facts_layout(facts):
+    # Only formats the precomputed facts, nothing here grows with the number of messages
+    if facts is None:
+        return dbc.Row([
+            dbc.Col([
+                html.H3("Facts"),
+                html.H5("No facts yet"),
+            ], width=12),
+        ])
+    streak, busiest, replier = facts['longest_streak'], facts['busiest_day'], facts['fastest_replier']
+    cards = [
+        fact_card("Messages", f"{facts['messages']:,}",
+                  f"{facts['sent']:,} sent across {facts['chats']} chats since {facts['first_message']}"),
+        fact_card("Longest streak", f"{streak['days']} days",
+                  f"with {streak['chat_name']} on {streak['platform']}, {streak['start']} to {streak['end']}"),
+        fact_card("Busiest day", busiest['date'], f"{busiest['messages']:,} messages, {busiest['sent']:,} of them yours"),
+        fact_card("Night owl", f"{facts['night_owl_share']:.1%}", "of your messages were sent between midnight and 5am"),
     ]
-)
-def update_response_time_distplot(start_date, end_date, platforms, pathname, chat_id):
-    filtered_df = filter_dataframe(msg_df, start_date, end_date, platforms, pathname, chat_id)
-
-    fig = response_time_distplot(filtered_df)
-    return fig
+    if replier:
+        cards.append(fact_card("Fastest replier", replier['person_name'],
+                               f"replies in {format_duration(replier['median_seconds'])} (median of "
+                               f"{replier['replies']:,} replies), you take "
+                               f"{format_duration(replier['your_median_seconds'])}"))
+    cards.append(fact_card("Top words", ", ".join(word['word'] for word in facts['top_words'][:3]) or "-",
+                           ", ".join(f"{word['word']} ({word['count']:,})" for word in facts['top_words'])))
+    return dbc.Row([
+        dbc.Col([
+            html.H3("Facts"),
+        ], width=12),
+    ] + cards)
 
 # Define the callback to update the page content based on the URL
 @app.callback(
-    Output('page-content', 'children'),
-    [Input('url', 'pathname')]
+    [Output('page-content', 'children'), Output('loading_poll', 'disabled')],
+    [Input('url', 'pathname'), Input('loading_poll', 'n_intervals')]
 )
-def display_page(pathname):
-    if pathname == '/dms' or pathname == '/':
+@profiled
+@stage
+def display_page(pathname, _):
+    # Polls while messages load
+    loading = dbc.Container([
+        dbc.Spinner(color="light"),
+        html.H5("Loading messages..."),
+    ], style={"padding-top": "2rem", "text-align": "center"}), False
+    if not data_ready.is_set():
+        return loading
+
+    user, page = parse_path(pathname)
+    if user is None:
+        return dbc.Container([
+            html.H5("Unknown user"),
+        ], style={"padding-top": "2rem", "text-align": "center"}), True
+    # The first user's pages are also served without the prefix
+    prefix = '' if user == next(iter(users)) else f'/{user}'
+    snapshot = get_snapshot(user)
+    if snapshot is None:
+        return loading
+    unique_chats = snapshot['chats']
+    last_date = snapshot['last_date']
+    if last_date is None:
+        return dbc.Container([
+            html.H5("No messages yet"),
+        ], style={"padding-top": "2rem", "text-align": "center"}), True
+
+    if page == '/dms':
         chat_list = unique_chats[unique_chats['chat_type'] == 'dm']
     else:
         chat_list = unique_chats[unique_chats['chat_type'] == 'group']
 
     chat_list = [{'label': "ALL chats", 'value': False}] + [{'label': row['display_name'], 'value': row['chat_id']}
                                                      for _, row in chat_list.iterrows()]
+    navbar = dbc.NavbarSimple(
+        children=[
+            dbc.NavItem(dbc.NavLink("DMs", href=f"{prefix}/dms")),
+            dbc.NavItem(dbc.NavLink("Groups", href=f"{prefix}/groups")),
+            dbc.NavItem(dbc.NavLink("Facts 💅🏻", href=f"{prefix}/facts"))
+        ],
+        brand="Texting Wrapped",
+        color="light",
+    )
+    if page == '/facts':
+        # Polls until the facts job has stored the facts of this version
+        facts = get_facts(snapshot)
+        return (dbc.Container([navbar, facts_layout(facts)], fluid=True, style={"padding-left": "0"}),
+                'facts' in snapshot)
+
     return dbc.Container([
-        dbc.NavbarSimple(
-            children=[
-                dbc.NavItem(dbc.NavLink("DMs", href="/dms")),
-                dbc.NavItem(dbc.NavLink("Groups", href="/groups")),
-                # TODO: Add a new page for facts
-                dbc.NavItem(dbc.NavLink("Facts 💅🏻", href="/facts"))
-            ],
-            brand="Texting Wrapped",
-            color="light",
-        ),
+        navbar,
         dbc.Row([
             dbc.Col([
                 dbc.Card(
@@ -205,8 +523,8 @@ def display_page(pathname):
                         dcc.DatePickerRange(
                             id='date_picker',
                             # start_date=msg_df['datetime'].min().date(),
-                            start_date=dt.date(2024, 1, 1),
-                            end_date=msg_df['datetime'].max().date(),
+                            start_date=DEFAULT_START_DATE,
+                            end_date=last_date,
                         ),
                         dbc.Checklist(
                             options=[
@@ -231,6 +549,9 @@ def display_page(pathname):
             dbc.Col([
                 html.H3("Messaging timeline"),
             ], width=12),
+            dbc.Col([
+                dcc.Graph(id="activity_trend_lineplot")
+            ], width=12),
             dbc.Col([
                 dcc.Graph(id="weekday_histogram")
             ], width=6),
@@ -260,12 +581,24 @@ def display_page(pathname):
             ], width=12),
             dbc.Col([
                 dcc.Graph(id="response_time_distplot")
-            ], width=6),
+            ], width=4),
+            dbc.Col([
+                dcc.Graph(id="response_time_density_plot")
+            ], width=4),
+            dbc.Col([
+                dcc.Graph(id="median_reply_time_lineplot")
+            ], width=4),
             # dbc.Col([
             #     dcc.Graph(id="messages_per_platform_histogram")
             # ], width=6),
         ])
-    ], fluid=True, style={"padding-left": "0"})
+    ], fluid=True, style={"padding-left": "0"}), True
 
 if __name__ == '__main__':
+    import os
+
+    logging.basicConfig(level=logging.INFO)
+    # The reloader runs this block in a watching parent and again in the serving child, which it marks
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_loader()
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+from msg_store import load_user_msg_df, read_rollup, read_snapshot, store_snapshot
+from text_stats import token_frequencies
+from users import load_users
+
+# Wrapped-style facts of a user's whole history, computed by a batch job and stored next to the user's store as
+# facts.json, tagged with the data version they were computed from. The job runs where messages are ingested (this
+# script, serve.py's publish, the dashboard's loader and refresher), the /facts page only reads that file. It never
+# holds the whole table: counts, the streak and the busiest day come from the day rollup, the replies, the night
+# owl messages and the words from one year of the columns they need at a time, merged.
+#   python facts.py    rebuilds the facts of every user whose data changed
+
+FACTS_FILE = 'facts.json'
+# Messages sent in [0h, 5h) count as night owl messages
+NIGHT_HOURS = (0, 5)
+# The fastest replier needs at least this many replies to count
+MIN_REPLIES = 20
+TOP_WORDS = 10
+# The columns read from every year of the table
+YEAR_COLUMNS = ['datetime', 'person_name', 'sent', 'response_time', 'reply_to_owner', 'msg_type', 'msg_content']
+# Left out of the top words, along with anything shorter than 3 characters
+STOPWORDS = {'the', 'and', 'you', 'that', 'for', 'are', 'but', 'not', 'with', 'this', 'have', 'was', 'what', 'just',
+             'your', 'all', 'can', 'i\'m', 'it\'s', 'don\'t', 'les', 'des', 'est', 'pas', 'que', 'qui', 'une', 'pour',
+             'dans', 'avec', 'mais', 'sur', 'moi', 'toi'}
+
+
+def longest_streak(days):
+    # Longest run of consecutive days with at least one message in the same chat, days is the day rollup
+    days = days.drop_duplicates(['platform', 'chat_id', 'datetime']).sort_values(['platform', 'chat_id', 'datetime'],
+                                                                                 ignore_index=True)
+    chat = days.groupby(['platform', 'chat_id'], sort=False, observed=True).ngroup().to_numpy()
+    day_number = days['datetime'].to_numpy('datetime64[D]').astype('int64')
+    new_run = np.ones(len(days), dtype=bool)
+    new_run[1:] = (chat[1:] != chat[:-1]) | (np.diff(day_number) != 1)
+    run = np.cumsum(new_run) - 1
+    lengths = np.bincount(run)
+    rows = np.flatnonzero(run == lengths.argmax())
+    first, last = days.iloc[rows[0]], days.iloc[rows[-1]]
+    return {'days': int(lengths.max()), 'chat_name': str(first['chat_name']), 'platform': str(first['platform']),
+            'start': first['datetime'].date().isoformat(), 'end': last['datetime'].date().isoformat()}
+
+
+def busiest_day(days):
+    messages = days.groupby('datetime')['message_count'].sum()
+    sent = days[days['sent'].astype(bool)].groupby('datetime')['message_count'].sum()
+    date = messages.idxmax()
+    return {'date': date.date().isoformat(), 'messages': int(messages[date]), 'sent': int(sent.get(date, 0))}
+
+
+def fastest_replier(msg_df, min_replies=MIN_REPLIES):
+    # The person whose replies to the owner have the lowest median response time, and the owner's own median.
+    # A reply in a group only counts when it follows a message of the owner.
+    replies = msg_df[msg_df['response_time'].notna()]
+    seconds = replies['response_time'].dt.total_seconds()
+    to_owner = replies['reply_to_owner'] & ~replies['sent']
+    by_person = seconds[to_owner].groupby(replies['person_name'][to_owner], observed=True).agg(['median', 'size'])
+    by_person = by_person[by_person['size'] >= min_replies]
+    if by_person.empty:
+        return None
+    person = by_person['median'].idxmin()
+    own = seconds[replies['sent']]
+    return {'person_name': str(person), 'median_seconds': float(by_person.at[person, 'median']),
+            'replies': int(by_person.at[person, 'size']),
+            'your_median_seconds': float(own.median()) if len(own) else None}
+
+
+def top_words(counts, top=TOP_WORDS):
+    # The owner's most used words, counts holds token counts of the owner's messages (see token_frequencies)
+    counts = counts.groupby('token', as_index=False)['count'].sum().sort_values(
+        ['count', 'token'], ascending=[False, True], kind='stable', ignore_index=True)
+    counts = counts[(counts['token'].str.len() >= 3) & ~counts['token'].isin(STOPWORDS)].head(top)
+    return [{'word': word, 'count': int(count)} for word, count in zip(counts['token'], counts['count'])]
+
+
+def year_facts(msg_df):
+    # What the facts need from one year of messages: the replies, the owner's messages sent at night out of all of
+    # them, and the token counts of the owner's messages
+    own = msg_df[msg_df['sent']]
+    return {
+        'replies': msg_df.loc[msg_df['response_time'].notna(),
+                              ['person_name', 'sent', 'response_time', 'reply_to_owner']],
+        'night': int(own['datetime'].dt.hour.between(NIGHT_HOURS[0], NIGHT_HOURS[1] - 1).sum()),
+        'own': len(own),
+        'words': token_frequencies(own, by=()),
+    }
+
+
+@stage
+def compute_facts(snapshot):
+    # The facts of a snapshot (see msg_store.store_snapshot), None when it holds no message
+    days = read_rollup(snapshot, 'day')
+    if days.empty:
+        return None
+    sent = days['sent'].astype(bool)
+    years = [year_facts(read_snapshot(snapshot, years=(year, year), columns=YEAR_COLUMNS))
+             for year in sorted(days['datetime'].dt.year.unique())]
+    own = sum(year['own'] for year in years)
+    return {
+        'messages': int(days['message_count'].sum()),
+        'sent': int(days.loc[sent, 'message_count'].sum()),
+        'chats': int(days[['platform', 'chat_id']].drop_duplicates().shape[0]),
+        'first_message': days['datetime'].min().date().isoformat(),
+        'longest_streak': longest_streak(days),
+        'busiest_day': busiest_day(days),
+        'fastest_replier': fastest_replier(pd.concat([year['replies'] for year in years], ignore_index=True)),
+        'top_words': top_words(pd.concat([year['words'] for year in years], ignore_index=True)),
+        # Share of the owner's messages sent at night
+        'night_owl_share': sum(year['night'] for year in years) / own if own else 0.0,
+    }
+
+
+def build_facts(user, snapshot=None):
+    # Stores the facts of user (a config of users.py) as of snapshot (see msg_store.store_snapshot), by default
+    # after ingesting the user's newer exports
+    if snapshot is None:
+        load_user_msg_df(user, read=False)
+        snapshot = store_snapshot(user['cache_dir'])
+    facts = compute_facts(snapshot)
+    path = os.path.join(user['cache_dir'], FACTS_FILE)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': snapshot['version'], 'facts': facts}, f, indent=1, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return facts
+
+
+def read_facts(user, version):
+    # The stored facts of user as {'version': ..., 'facts': ...}, None unless they were computed from version
+    try:
+        with open(os.path.join(user['cache_dir'], FACTS_FILE), 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return stored if stored['version'] == version else None
+
+
+def load_facts(user, snapshot=None):
+    # The stored facts of user, rebuilt first when they are older than snapshot (the stored messages by default)
+    snapshot = snapshot or store_snapshot(user['cache_dir'])
+    stored = read_facts(user, snapshot['version'])
+    if stored:
+        return stored['facts']
+    return build_facts(user, snapshot)
+
+
+if __name__ == '__main__':
+    for name, config in load_users().items():
+        # Newer exports change the data version, the facts are then rebuilt
+        load_user_msg_df(config, read=False)
+        print(name, json.dumps(load_facts(config), indent=1, ensure_ascii=False))
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly.io as pio
+
+# Rendered figures keyed by builder name and normalized filter state. The in-memory part is a size-bounded
+# LRU, figures put with persist=True are also written as Plotly JSON under cache_dir/<data version>/, at most
+# max_files of them (the oldest go first).
+
+
+def normalize_filter_state(start_date, end_date, platforms, pathname, chat_id):
+    # Equivalent filter inputs map to the same key: '/' is the DM page, no chat is None
+    # and the date picker may send either dates or datetimes
+    return (
+        pd.Timestamp(start_date).isoformat(),
+        pd.Timestamp(end_date).isoformat(),
+        tuple(sorted(platforms or [])),
+        '/dms' if pathname == '/' else pathname,
+        chat_id or None,
+    )
+
+
+class FigureCache:
+    def __init__(self, max_entries=256, cache_dir=None, max_files=1024):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self.files = 0
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, str(self.version), digest + '.json')
+
+    def get(self, name, filter_state):
+        key = (name,) + filter_state
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.cache_dir and os.path.exists(self._path(key)):
+            fig = pio.read_json(self._path(key))
+            self.put(name, filter_state, fig, persist=False)
+            self.hits += 1
+            return fig
+        self.misses += 1
+        return None
+
+    def put(self, name, filter_state, fig, persist=False):
+        key = (name,) + filter_state
+        with self.lock:
+            self.entries[key] = fig
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if persist and self.cache_dir:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Unique temporary name, several worker processes may render the same figure
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            pio.write_json(fig, tmp_path)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.files += 1
+                full = self.files > self.max_files
+            if full:
+                self._prune()
+
+    def _folder(self):
+        return os.path.join(self.cache_dir, str(self.version))
+
+    def _prune(self):
+        # Down to three quarters of max_files, least recently written first. Other processes may be pruning
+        # the same folder.
+        folder = self._folder()
+        paths = []
+        for file_name in os.listdir(folder):
+            try:
+                paths.append((os.path.getmtime(os.path.join(folder, file_name)), os.path.join(folder, file_name)))
+            except OSError:
+                pass
+        paths = [path for _, path in sorted(paths) if path.endswith('.json')]
+        for path in paths[:max(len(paths) - self.max_files * 3 // 4, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self.lock:
+            self.files = min(len(paths), self.max_files * 3 // 4)
+
+    def invalidate(self, version):
+        # New message data: drop every figure built from the previous version
+        with self.lock:
+            self.entries.clear()
+            self.version = version
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for entry in os.listdir(self.cache_dir):
+                if entry != str(version):
+                    shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors=True)
+            if os.path.isdir(self._folder()):
+                self.files = len(os.listdir(self._folder()))
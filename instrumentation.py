@@ -0,0 +1,132 @@
+import cProfile
+import functools
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Opt-in timings of the ingest stages, the dashboard filter, figure builds and callbacks. Off unless
+# TEXTINGWRAPPED_PROFILE is set before the modules are imported, decorated functions are then left untouched.
+#   TEXTINGWRAPPED_PROFILE=1          wall time and rows in/out per stage, served on /metrics
+#   TEXTINGWRAPPED_PROFILE_MEMORY=1   also the memory allocated by every stage (tracemalloc, slows everything down)
+#   TEXTINGWRAPPED_PROFILE_DIR=path   also a cProfile dump per dashboard callback, open with snakeviz or pstats
+# Memory is traced process-wide, so with several callbacks running in threads at once the figures overlap.
+
+ENABLED = bool(os.environ.get('TEXTINGWRAPPED_PROFILE'))
+TRACE_MEMORY = ENABLED and bool(os.environ.get('TEXTINGWRAPPED_PROFILE_MEMORY'))
+PROFILE_DIR = os.environ.get('TEXTINGWRAPPED_PROFILE_DIR') if ENABLED else None
+RECENT_EVENTS = 500
+
+_lock = threading.Lock()
+_stages = {}
+_recent = deque(maxlen=RECENT_EVENTS)
+# Stages open in the current thread, so that a stage's memory peak includes the stages nested in it
+_open = threading.local()
+
+if TRACE_MEMORY:
+    tracemalloc.start()
+
+
+def _rows(value):
+    # Length of a frame or array, None for anything else
+    shape = getattr(value, 'shape', None)
+    return shape[0] if shape else None
+
+
+def _record(name, event):
+    with _lock:
+        _recent.append(dict(event, stage=name))
+        stats = _stages.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows_in': 0, 'rows_out': 0,
+                                          'allocated_kb': 0.0, 'peak_kb': 0.0})
+        stats['calls'] += 1
+        stats['total_ms'] += event['wall_ms']
+        stats['max_ms'] = max(stats['max_ms'], event['wall_ms'])
+        stats['rows_in'] += event['rows_in'] or 0
+        stats['rows_out'] += event['rows_out'] or 0
+        if TRACE_MEMORY:
+            stats['allocated_kb'] += event['allocated_kb']
+            stats['peak_kb'] = max(stats['peak_kb'], event['peak_kb'])
+
+
+@contextmanager
+def measure(name, rows_in=None):
+    # Times the block, the caller can set rows_out on the yielded event
+    event = {'rows_in': rows_in, 'rows_out': None}
+    if not ENABLED:
+        yield event
+        return
+
+    stack = _open.__dict__.setdefault('stack', [])
+    if TRACE_MEMORY:
+        before, peak_before = tracemalloc.get_traced_memory()
+        # The peak is global, hand what it was so far to the enclosing stage before resetting it
+        if stack:
+            stack[-1] = max(stack[-1], peak_before)
+        tracemalloc.reset_peak()
+    stack.append(0)
+    start = time.perf_counter()
+    try:
+        yield event
+    finally:
+        event['wall_ms'] = (time.perf_counter() - start) * 1000
+        nested_peak = stack.pop()
+        if TRACE_MEMORY:
+            after, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, nested_peak)
+            event['allocated_kb'] = (after - before) / 1024
+            event['peak_kb'] = (peak - before) / 1024
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+        event['finished'] = time.time()
+        _record(name, event)
+
+
+def stage(function=None, name=None):
+    # Decorator recording every call of function as a stage, rows in is the first frame argument
+    if function is None:
+        return functools.partial(stage, name=name)
+    if not ENABLED:
+        return function
+    name = name or f'{function.__module__}.{function.__name__}'
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rows_in = next((_rows(arg) for arg in args if _rows(arg) is not None), None)
+        with measure(name, rows_in) as event:
+            result = function(*args, **kwargs)
+            event['rows_out'] = _rows(result)
+        return result
+    return wrapper
+
+
+def profiled(function):
+    # Decorator dumping a cProfile of every call into PROFILE_DIR, for the dashboard callbacks
+    if not PROFILE_DIR:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile.dump_stats(os.path.join(PROFILE_DIR, f'{function.__name__}-{time.time_ns()}-'
+                                                         f'{threading.get_ident()}.prof'))
+    return wrapper
+
+
+def snapshot():
+    # Per stage totals and the most recent calls, what /metrics serves
+    with _lock:
+        stages = {name: dict(stats, mean_ms=stats['total_ms'] / stats['calls']) for name, stats in _stages.items()}
+        return {'enabled': ENABLED, 'trace_memory': TRACE_MEMORY, 'pid': os.getpid(), 'stages': stages,
+                'recent': list(_recent)}
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _recent.clear()
@@ -1,117 +1,424 @@
+import numpy as np
 import pandas as pd
 import zipfile
 import os
 import re
-from datetime import datetime as dt
 import json
+from concurrent.futures import ProcessPoolExecutor
 
-# TODO: add links as type of messages
-
-def whatsapp2df(folder_path):
-    data = []
-    weird_chars = ['\u202a', '\u202c', '\xa0', '\u200e', '\u202f']
-    chat_id_counter = 0
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.zip') and file_name.startswith('WhatsApp Chat - '):
-            chat_name = file_name[16:-4]
-            chat_id_counter += 1
-            with zipfile.ZipFile(os.path.join(folder_path, file_name), 'r') as zip_ref:
-                for inner_file in zip_ref.namelist():
-                    if inner_file.endswith('_chat.txt'):
-                        with zip_ref.open(inner_file) as f:
-                            content = f.read().decode('utf-8')
-                            content = content.translate(str.maketrans('', '', ''.join(weird_chars)))
-                            messages = content.split('\r\n')
-                            for line in messages:
-                                if "Messages and calls are end-to-end encrypted. No one outside of this chat" in line:
-                                    continue
-                                match = re.match(r'\[(\d{2}\.\d{2}\.\d{2}), (\d{2}:\d{2}:\d{2})\] (.*?): (.*)', line)
-                                if match:
-                                    date_str, time_str, person_name, msg_content = match.groups()
-                                    datetime_str = f"{date_str} {time_str}"
-                                    datetime_obj = dt.strptime(datetime_str, '%d.%m.%y %H:%M:%S')
-                                    day_of_the_week = datetime_obj.strftime('%A')
-
-                                    if msg_content == "audio omitted":
-                                        msg_type = "audio"
-                                    elif msg_content == "image omitted":
-                                        msg_type = "image"
-                                    elif msg_content == "video omitted":
-                                        msg_type = "video"
-                                    else:
-                                        msg_type = "text"
-
-                                    word_count = len(msg_content.split())
-                                    data.append([datetime_obj, day_of_the_week, chat_name, chat_id_counter, person_name, msg_type, msg_content, word_count])
-
-    df = pd.DataFrame(data, columns=['datetime', 'day_of_the_week', 'chat_name', 'chat_id', 'person_name', 'msg_type', 'msg_content', 'word_count'])
-    df.insert(2, 'platform', 'whatsapp')
+from instrumentation import stage
+from response_times import add_response_times
+from text_stats import text_stats
+
+
+WHATSAPP_COLUMNS = ['datetime', 'day_of_the_week', 'platform', 'chat_name', 'chat_type', 'chat_id', 'person_name',
+                    'msg_type', 'has_link', 'has_emoji', 'msg_content', 'word_count', 'char_count']
+WHATSAPP_MESSAGE_START = r'\[\d{2}\.\d{2}\.\d{2}, \d{2}:\d{2}:\d{2}\] '
+# One match per message: the header line plus every following line that doesn't start a new message
+WHATSAPP_MESSAGE = re.compile(r'^\[(\d{2}\.\d{2}\.\d{2}), (\d{2}:\d{2}:\d{2})\] (.*?): (.*(?:\n(?!'
+                              + WHATSAPP_MESSAGE_START + r').*)*)', re.MULTILINE)
+WHATSAPP_WEIRD_CHARS = ['\u202a', '\u202c', '\xa0', '\u200e', '\u202f']
+WHATSAPP_MEDIA = {'audio omitted': 'audio', 'image omitted': 'image', 'video omitted': 'video'}
+WHATSAPP_ENCRYPTION_NOTICE = "Messages and calls are end-to-end encrypted. No one outside of this chat"
+
+
+def _fixed_width_digits(strings, width):
+    # View equally sized ASCII strings as a (n, width) matrix of digit values
+    return (np.array(strings, dtype=f'S{width}').view(np.uint8).reshape(-1, width) - ord('0')).astype(np.int64)
+
+
+def _whatsapp_timestamps(dates, times):
+    # dd.mm.yy and HH:MM:SS are fixed width, so fields are read by position instead of strptime
+    d, t = _fixed_width_digits(dates, 8), _fixed_width_digits(times, 8)
+    return pd.to_datetime(pd.DataFrame({
+        'year': 2000 + d[:, 6] * 10 + d[:, 7], 'month': d[:, 3] * 10 + d[:, 4], 'day': d[:, 0] * 10 + d[:, 1],
+        'hour': t[:, 0] * 10 + t[:, 1], 'minute': t[:, 3] * 10 + t[:, 4], 'second': t[:, 6] * 10 + t[:, 7],
+    }))
+
+
+def whatsapp_chat2df(content, chat_name, chat_id):
+    # Parse a whole _chat.txt in a single regex scan, multi-line messages are kept whole
+    for char in WHATSAPP_WEIRD_CHARS:
+        content = content.replace(char, '')
+    messages = pd.DataFrame(WHATSAPP_MESSAGE.findall(content.replace('\r\n', '\n')),
+                            columns=['date', 'time', 'person_name', 'msg_content'], dtype=object)
+    messages['msg_content'] = messages['msg_content'].str.rstrip('\n')
+    messages = messages[~messages['msg_content'].str.contains(WHATSAPP_ENCRYPTION_NOTICE, regex=False)].reset_index(drop=True)
+
+    datetimes = _whatsapp_timestamps(messages['date'], messages['time'])
+    stats = text_stats(messages['msg_content'])
+    return pd.DataFrame({
+        'datetime': datetimes,
+        'day_of_the_week': datetimes.dt.day_name(),
+        'platform': 'whatsapp',
+        'chat_name': chat_name,
+        'chat_id': chat_id,
+        'person_name': messages['person_name'],
+        'msg_type': messages['msg_content'].map(WHATSAPP_MEDIA).fillna('text'),
+        'has_link': stats['has_link'],
+        'has_emoji': stats['has_emoji'],
+        'msg_content': messages['msg_content'],
+        'word_count': stats['word_count'],
+        'char_count': stats['char_count'],
+    })
+
+
+@stage
+def whatsapp_zip2df(zip_path, chat_name, chat_id):
+    frames = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for inner_file in zip_ref.namelist():
+            if inner_file.endswith('_chat.txt'):
+                with zip_ref.open(inner_file) as f:
+                    frames.append(whatsapp_chat2df(f.read().decode('utf-8'), chat_name, chat_id))
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def whatsapp_archives(folder_path):
+    # Sorted so that chat ids don't depend on the directory listing order
+    file_names = sorted(file_name for file_name in os.listdir(folder_path)
+                        if file_name.endswith('.zip') and file_name.startswith('WhatsApp Chat - '))
+    return [(os.path.join(folder_path, file_name), file_name[16:-4], chat_id)
+            for chat_id, file_name in enumerate(file_names, start=1)]
+
+
+def merge_whatsapp_dfs(frames):
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return pd.DataFrame(columns=WHATSAPP_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)
     chats_participant_count = df.groupby('chat_name')['person_name'].nunique()
-    df['chat_type'] = df['chat_name'].apply(lambda x: 'group' if chats_participant_count[x] > 2 else 'dm')
-    df.insert(4, 'chat_type', df.pop('chat_type'))
+    df.insert(4, 'chat_type', df['chat_name'].map(chats_participant_count.gt(2).map({True: 'group', False: 'dm'})))
     return df
 
-def telegram2df(json_path):
+
+@stage
+def whatsapp2df(folder_path, workers=1):
+    # workers=None uses one process per core
+    archives = whatsapp_archives(folder_path)
+    if workers == 1:
+        return merge_whatsapp_dfs(whatsapp_zip2df(*archive) for archive in archives)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(whatsapp_zip2df, *archive) for archive in archives]
+        return merge_whatsapp_dfs(future.result() for future in futures)
+
+
+TELEGRAM_COLUMNS = ['datetime', 'day_of_the_week', 'platform', 'chat_name', 'chat_id', 'chat_type', 'person_name',
+                    'person_id', 'msg_type', 'has_link', 'has_emoji', 'msg_content', 'word_count', 'char_count']
+
+
+class _JsonStream:
+    # Minimal pull parser: only the containers we walk into are tokenized, every leaf
+    # value is decoded on its own so memory stays bounded by the largest single message
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' in JSON stream, got '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number touching the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        if self.peek() == '{':
+            for _ in self.items():
+                self.skip()
+        elif self.peek() == '[':
+            for _ in self.elements():
+                self.skip()
+        else:
+            self.value()
+
+    def items(self):
+        # Yields the keys of an object, the caller has to consume each value
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self.pos += 1
+
+    def elements(self):
+        # Yields once per array element, the caller has to consume each element
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+
+
+def _telegram_batch(columns):
+    datetimes = pd.to_datetime(pd.Series(columns['datetime'], dtype=object), format='ISO8601')
+    stats = text_stats(pd.Series(columns['msg_content'], dtype=object))
+    return pd.DataFrame({
+        'datetime': datetimes,
+        'day_of_the_week': datetimes.dt.day_name(),
+        'platform': 'telegram',
+        'chat_name': columns['chat_name'],
+        'chat_id': columns['chat_id'],
+        'chat_type': columns['chat_type'],
+        'person_name': columns['person_name'],
+        'person_id': columns['person_id'],
+        'msg_type': columns['msg_type'],
+        # Link entities, or links written out in plain text
+        'has_link': stats['has_link'] | np.array(columns['has_link'], dtype=bool),
+        'has_emoji': stats['has_emoji'],
+        'msg_content': columns['msg_content'],
+        'word_count': stats['word_count'],
+        'char_count': stats['char_count'],
+    }, columns=TELEGRAM_COLUMNS)
+
+
+def iter_telegram_batches(json_path, batch_size=100_000):
+    # Walk chats.list[*].messages[*] without loading the export, emitting DataFrames of at most batch_size rows
+    names = ['datetime', 'chat_name', 'chat_id', 'chat_type', 'person_name', 'person_id', 'msg_type', 'has_link',
+             'msg_content']
+    columns = {name: [] for name in names}
     with open(json_path, 'r', encoding='utf-8') as file:
-        chats = json.load(file)['chats']['list']
-
-    data = []
-    for chat in chats:
-        chat_name = chat['name']
-        chat_id = chat['id']
-        chat_type = 'group' if chat['type'] in ['private_group', 'private_supergroup'] else 'dm'
-        for message in chat['messages']:
-            if message['type'] == 'message':
-                datetime_obj = dt.fromisoformat(message['date'])
-                day_of_the_week = datetime_obj.strftime('%A')
-                person_name = message['from']
-                person_id = message['from_id']
-                msg_content, has_link = extract_text(message['text'])
-                msg_type = message.get('mime_type', 'text')
-
-                word_count = len(msg_content.split())
-                data.append([datetime_obj, day_of_the_week, chat_name, chat_id, chat_type, person_name, person_id, msg_type, has_link, msg_content, word_count])
-
-    df = pd.DataFrame(data, columns=['datetime', 'day_of_the_week', 'chat_name', 'chat_id', 'chat_type', 'person_name', 'person_id', 'msg_type', 'has_link', 'msg_content', 'word_count'])
-    df.insert(2, 'platform', 'telegram')
-    return df
+        stream = _JsonStream(file)
+        for key in stream.items():
+            if key != 'chats':
+                stream.skip()
+                continue
+            for chats_key in stream.items():
+                if chats_key != 'list':
+                    stream.skip()
+                    continue
+                for _ in stream.elements():
+                    chat = {}
+                    for chat_key in stream.items():
+                        if chat_key in ('name', 'type', 'id'):
+                            chat[chat_key] = stream.value()
+                            continue
+                        if chat_key != 'messages':
+                            stream.skip()
+                            continue
+                        if 'type' not in chat:
+                            raise ValueError('Telegram export lists chat messages before the chat metadata')
+                        chat_type = 'group' if chat['type'] in ['private_group', 'private_supergroup'] else 'dm'
+                        for _ in stream.elements():
+                            message = stream.value()
+                            if message['type'] != 'message':
+                                continue
+                            msg_content, has_link = extract_text(message['text'])
+                            columns['datetime'].append(message['date'])
+                            columns['chat_name'].append(chat['name'])
+                            columns['chat_id'].append(chat['id'])
+                            columns['chat_type'].append(chat_type)
+                            columns['person_name'].append(message['from'])
+                            columns['person_id'].append(message['from_id'])
+                            columns['msg_type'].append(message.get('mime_type', 'text'))
+                            columns['has_link'].append(has_link)
+                            columns['msg_content'].append(msg_content)
+                            if len(columns['datetime']) >= batch_size:
+                                yield _telegram_batch(columns)
+                                columns = {name: [] for name in names}
+    if columns['datetime']:
+        yield _telegram_batch(columns)
+
+
+@stage
+def telegram2df(json_path, batch_size=100_000):
+    batches = list(iter_telegram_batches(json_path, batch_size))
+    if not batches:
+        return pd.DataFrame(columns=TELEGRAM_COLUMNS)
+    return pd.concat(batches, ignore_index=True)
 
 
 def extract_text(text):
     has_link = False
     if isinstance(text, list):
-        full_text = ''
+        parts = []
         for item in text:
             if isinstance(item, dict) and item.get('type') == 'link':
                 has_link = True
-            full_text += item['text'] if isinstance(item, dict) else item
-        return full_text, has_link
+            parts.append(item['text'] if isinstance(item, dict) else item)
+        return ''.join(parts), has_link
     return text, has_link
 
 
-def msg2df(telegram_file = 'data/telegram.json', whatsapp_folder = 'data/whatsapp'):
-    whatsapp_df = whatsapp2df(whatsapp_folder)
-    telegram_df = telegram2df(telegram_file)
+# The person whose messages count as sent, see users.py
+OWNER = {'names': ['kais'], 'telegram_ids': []}
+
+
+def telegram_owner_id(json_path):
+    # from_id of the account the export belongs to, personal_information comes first in Telegram exports
+    with open(json_path, 'r', encoding='utf-8') as file:
+        stream = _JsonStream(file)
+        for key in stream.items():
+            if key == 'personal_information':
+                user_id = stream.value().get('user_id')
+                return None if user_id is None else f'user{user_id}'
+            stream.skip()
+    return None
+
+
+def resolve_owner(owner, telegram_file=None):
+    # Without configured Telegram ids, the owner's account is the one the export belongs to
+    if owner.get('telegram_ids') or not telegram_file:
+        return owner
+    owner_id = telegram_owner_id(telegram_file)
+    return dict(owner, telegram_ids=[owner_id]) if owner_id else owner
+
 
-    # Concatenate the DataFrames, keeping all columns
-    combined_df = pd.concat([telegram_df, whatsapp_df], ignore_index=True, sort=False)
-    combined_df = combined_df[telegram_df.columns]
+def owner_messages(msg_df, owner):
+    # Telegram messages are the owner's by from_id when the owner's accounts are known, any other message
+    # when its sender name is one of the owner's names. WhatsApp-only frames have no person_id.
+    sent = msg_df['person_name'].str.lower().isin([name.lower() for name in owner['names']])
+    if owner.get('telegram_ids') and 'person_id' in msg_df:
+        by_id = msg_df['person_id'].isin(owner['telegram_ids'])
+        sent = sent.where(msg_df['platform'].ne('telegram'), by_id)
+    return sent
 
-    # Add response time column
-    combined_df = combined_df.sort_values(by=['chat_name', 'datetime'])
+
+def msg2df(telegram_file = 'data/telegram.json', whatsapp_folder = 'data/whatsapp', workers=1, owner=OWNER):
+    owner = resolve_owner(owner, telegram_file)
+    if workers == 1:
+        whatsapp_df = whatsapp2df(whatsapp_folder)
+        telegram_df = telegram2df(telegram_file)
+    else:
+        # The Telegram export and every archive go to the same pool, frames are merged in
+        # submission order so the result doesn't depend on which worker finishes first
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            telegram_future = executor.submit(telegram2df, telegram_file)
+            whatsapp_futures = [executor.submit(whatsapp_zip2df, *archive)
+                                for archive in whatsapp_archives(whatsapp_folder)]
+            whatsapp_df = merge_whatsapp_dfs(future.result() for future in whatsapp_futures)
+            telegram_df = telegram_future.result()
+    return combine_msg_dfs(telegram_df, whatsapp_df, owner)
+
+
+@stage
+def combine_msg_dfs(telegram_df, whatsapp_df, owner=OWNER):
+    # Concatenate the DataFrames, keeping all columns. A user may have no Telegram export (None)
+    # or no WhatsApp chats (empty)
+    frames = [df for df in [telegram_df, whatsapp_df] if df is not None and not df.empty]
+    if not frames:
+        frames = [pd.DataFrame(columns=TELEGRAM_COLUMNS).astype({'datetime': 'datetime64[ns]'})]
+    combined_df = pd.concat(frames, ignore_index=True, sort=False)
+    combined_df = combined_df.reindex(columns=TELEGRAM_COLUMNS)
 
     # Add sent and received columns
-    combined_df['sent'] = combined_df['person_name'].str.lower().eq('kais')
+    combined_df['sent'] = owner_messages(combined_df, owner)
     combined_df['received'] = ~combined_df['sent']
 
-    # Group by chat_name and calculate the response time
-    combined_df['previous_datetime'] = combined_df.groupby('chat_id')['datetime'].shift(1)
-    combined_df['response_time'] = combined_df['datetime'] - combined_df['previous_datetime']
+    # Sort by chat and time, and add the reply times and conversation sessions
+    return add_response_times(combined_df)
+
+
+@stage
+def find_new_messages(msg_df, new_df, owner=OWNER):
+    # Messages of a newer export that aren't in the combined frame yet: everything after the last stored
+    # timestamp of their chat, with sent, received and the reply columns computed for those rows only
+    keys = ['platform', 'chat_id']
+    new_df = new_df.join(msg_df.groupby(keys)['datetime'].max().rename('last_seen'), on=keys)
+    is_new = new_df['last_seen'].isna() | (new_df['datetime'] > new_df['last_seen'])
+
+    # Overlapping export windows share the boundary second, match those rows against the stored ones
+    on_boundary = new_df['datetime'].eq(new_df['last_seen'])
+    if on_boundary.any():
+        match = keys + ['datetime', 'person_name', 'msg_content']
+        boundary = new_df.loc[on_boundary, match]
+        stored = msg_df.loc[msg_df['datetime'].isin(boundary['datetime'].unique()), match]
+        stored = stored.merge(boundary[keys + ['datetime']].drop_duplicates(), on=keys + ['datetime'])
+        # Number identical messages so that only the extra copies count as new
+        boundary = boundary.assign(copy=boundary.groupby(match, dropna=False).cumcount())
+        stored = stored.assign(copy=stored.groupby(match, dropna=False).cumcount())
+        seen = boundary.reset_index().merge(stored, on=match + ['copy'])['index']
+        is_new |= on_boundary & ~new_df.index.isin(seen)
+
+    new_df = new_df[is_new].assign(sent=lambda df: owner_messages(df, owner))
+    new_df['received'] = ~new_df['sent']
+    # The first new message of a chat follows the last stored one
+    new_df = add_response_times(new_df, previous=msg_df.groupby(keys, observed=True).tail(1))
+    return new_df.reindex(columns=msg_df.columns)
+
+
+def retype_chats(msg_df, new_messages):
+    # A newer WhatsApp export can turn a dm into a group once a third person writes.
+    # Returns msg_df itself when no stored chat changed type.
+    keys = ['platform', 'chat_id']
+    new_types = new_messages.drop_duplicates(keys).set_index(keys)['chat_type']
+    stored_types = msg_df.drop_duplicates(keys).set_index(keys)['chat_type']
+    changed = new_types[new_types.ne(stored_types.reindex(new_types.index)) & new_types.index.isin(stored_types.index)]
+    if changed.empty:
+        return msg_df
+    msg_df = msg_df.copy()
+    msg_df['chat_type'] = msg_df.join(changed.rename('new_chat_type'), on=keys)['new_chat_type'].fillna(msg_df['chat_type'])
+    return msg_df
+
+
+def append_new_messages(msg_df, new_df, owner=OWNER):
+    new_messages = find_new_messages(msg_df, new_df, owner)
+    return pd.concat([retype_chats(msg_df, new_messages), new_messages], ignore_index=True)
+
+
+COMPACT_CATEGORIES = ['platform', 'chat_type', 'chat_name', 'person_name', 'person_id', 'msg_type']
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
-    # Drop the temporary column
-    combined_df = combined_df.drop(columns=['previous_datetime'])
 
-    return combined_df
+@stage
+def compact_msg_df(msg_df):
+    # Dictionary-encode the repeated strings, shrink the integers and leave the message bodies out,
+    # the weekday name is replaced by its code (0 is Monday, see WEEKDAYS)
+    compact = msg_df.drop(columns=['day_of_the_week', 'msg_content'], errors='ignore')
+    compact.insert(1, 'weekday', compact['datetime'].dt.dayofweek.astype('int8'))
+    for column in COMPACT_CATEGORIES:
+        compact[column] = compact[column].astype('category')
+    compact['chat_id'] = pd.to_numeric(compact['chat_id'], downcast='integer')
+    compact['word_count'] = pd.to_numeric(compact['word_count'], downcast='unsigned')
+    compact['char_count'] = pd.to_numeric(compact['char_count'], downcast='unsigned')
+    compact['has_link'] = compact['has_link'].eq(True)
+    compact['has_emoji'] = compact['has_emoji'].eq(True)
+    return compact
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+
+class MessageIndex:
+    # Row offsets into a frame kept sorted by datetime. Date ranges are resolved by binary search inside
+    # each (platform, chat_type) group or inside a single chat, so a query costs O(log n + rows returned).
+    # A range covers whole days, [start_date, end_date + 1 day), whatever the table's buckets are.
+    def __init__(self, df):
+        if not df['datetime'].is_monotonic_increasing:
+            df = df.sort_values('datetime', kind='stable', ignore_index=True)
+        self.df = df
+        datetimes = df['datetime'].to_numpy()
+        self.groups = {key: (rows, datetimes[rows]) for key, rows in
+                       df.groupby(['platform', 'chat_type'], observed=True).indices.items()}
+        self.chats = {chat_id: (rows, datetimes[rows]) for chat_id, rows in
+                      df.groupby('chat_id', observed=True).indices.items()}
+
+    @staticmethod
+    def _date_slice(rows, datetimes, start, end):
+        # rows are in datetime order, so the range is a contiguous slice
+        return rows[np.searchsorted(datetimes, start, side='left'):np.searchsorted(datetimes, end, side='left')]
+
+    def rows(self, start_date, end_date, platforms, chat_type, chat_id=None):
+        start = np.datetime64(pd.Timestamp(start_date))
+        end = np.datetime64(pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1))
+        if chat_id:
+            if chat_id not in self.chats:
+                return np.empty(0, dtype=np.intp)
+            rows = self._date_slice(*self.chats[chat_id], start, end)
+            # Only a handful of rows are left, check platform and chat type on them directly
+            keep = self.df['platform'].iloc[rows].isin(platforms) & self.df['chat_type'].iloc[rows].eq(chat_type)
+            return rows[keep.to_numpy()]
+        slices = [self._date_slice(*self.groups[(platform, chat_type)], start, end) for platform in platforms
+                  if (platform, chat_type) in self.groups]
+        return np.sort(np.concatenate(slices)) if slices else np.empty(0, dtype=np.intp)
+
+    def query(self, start_date, end_date, platforms, chat_type, chat_id=None):
+        return self.df.take(self.rows(start_date, end_date, platforms, chat_type, chat_id))
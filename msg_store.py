@@ -0,0 +1,399 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from aggregates import build_response_time_sketches, build_rollup, merge_rollups, sum_sketches, ROLLUP_GRANULARITIES
+from instrumentation import stage
+from io_utils import (telegram2df, whatsapp_zip2df, whatsapp_archives, merge_whatsapp_dfs, combine_msg_dfs,
+                      find_new_messages, retype_chats, resolve_owner, OWNER)
+
+# On-disk cache of the parsed message table of one user. Every source file gets its own Parquet file keyed by
+# path, size, mtime and content hash. The combined frame (with sent, received and response_time) is
+# stored as a list of append-only parts, so a warm start only reads those and a newer export only
+# adds a part holding its new messages. A part is a directory with one Parquet file per platform and year,
+# readers only open the files of the platforms and years they ask for. Parts are never modified, so a snapshot
+# of the manifest (see store_snapshot) reads the same rows until its parts are removed. Every part also holds the
+# trend rollups and the response time sketches of its messages (see aggregates) under rollups/, so they are
+# maintained at ingest.
+
+MANIFEST = 'manifest.json'
+ROLLUPS_DIR = 'rollups'
+SKETCHES_FILE = 'sketches.parquet'
+# Paths of the cube, the response time sketches and the trend rollups published by serve.py for its workers,
+# {user} stands for the user's name and {granularity} for the rollup's
+SHARED_CUBE_ENV = 'TEXTINGWRAPPED_SHARED_CUBE'
+SHARED_SKETCHES_ENV = 'TEXTINGWRAPPED_SHARED_SKETCHES'
+SHARED_ROLLUPS_ENV = 'TEXTINGWRAPPED_SHARED_ROLLUPS'
+# Seconds between two looks at the exports for newer messages by the dashboard (or by serve.py, which then
+# republishes), 0 turns refreshing off
+REFRESH_INTERVAL_ENV = 'TEXTINGWRAPPED_REFRESH_INTERVAL'
+DEFAULT_REFRESH_INTERVAL = 30
+MAX_PARTS = 16
+# Bumped whenever the columns of the parsed or combined frames, how they are computed or the files of a part
+# change, older caches are rebuilt from the sources
+COMBINED_VERSION = 8
+CHAT_COLUMNS = ['chat_name', 'platform', 'chat_id', 'chat_type']
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def source_fingerprint(path, previous=None):
+    # The content hash is only recomputed when size or mtime moved
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == value for key, value in fingerprint.items()):
+        fingerprint['sha1'] = previous['sha1']
+    else:
+        fingerprint['sha1'] = file_sha1(path)
+    return fingerprint
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'sources': {}, 'combined': None, 'parts': []}
+
+
+def _tmp_path(path):
+    # Unique per process and thread, so that two writers of one store never rename each other's file
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _write_manifest(cache_dir, manifest):
+    tmp_path = _tmp_path(os.path.join(cache_dir, MANIFEST))
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST))
+
+
+def _write_parquet(df, path, schema=None):
+    tmp_path = _tmp_path(path)
+    df.to_parquet(tmp_path, index=False, schema=schema)
+    os.replace(tmp_path, path)
+
+
+def _source_file(path):
+    return 'source-' + hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16] + '.parquet'
+
+
+def _parse_source(kind, args):
+    return telegram2df(*args) if kind == 'telegram' else whatsapp_zip2df(*args)
+
+
+def _part_files(cache_dir, parts, platforms=None, years=None):
+    # The Parquet files of parts in table order: part by part, then by platform and year. years is an inclusive
+    # (first, last) range
+    files = []
+    for part in parts:
+        for file_name in sorted(os.listdir(os.path.join(cache_dir, part))):
+            if not file_name.endswith('.parquet'):
+                continue
+            platform, year = file_name[:-8].rsplit('-', 1)
+            if (platforms is None or platform in platforms) and (years is None or years[0] <= int(year) <= years[1]):
+                files.append(os.path.join(cache_dir, part, file_name))
+    return files
+
+
+def _in_partitions(df, platforms=None, years=None):
+    # The rows _part_files would read
+    keep = np.ones(len(df), dtype=bool)
+    if platforms is not None:
+        keep &= df['platform'].isin(platforms).to_numpy()
+    if years is not None:
+        keep &= df['datetime'].dt.year.between(*years).to_numpy()
+    return keep
+
+
+def _read_parts(cache_dir, parts, columns=None, platforms=None, years=None):
+    files = _part_files(cache_dir, parts, platforms, years)
+    if not files:
+        # Nothing in range, an empty frame with the columns and dtypes of the table
+        every_file = _part_files(cache_dir, parts)
+        if not every_file:
+            return pd.DataFrame(columns=columns)
+        return pd.read_parquet(every_file[0], columns=columns).iloc[:0]
+    return pd.concat([pd.read_parquet(path, columns=columns) for path in files], ignore_index=True)
+
+
+def _partition_order(df):
+    # Rows grouped by platform then year the way _write_part lays them out, in their order within a partition
+    order = np.lexsort((df['datetime'].dt.year.to_numpy(), pd.factorize(df['platform'], sort=True)[0]))
+    return df.iloc[order].reset_index(drop=True)
+
+
+def _table_schema(df):
+    # One Arrow schema for every file of the table, so that a partition without Telegram rows still stores
+    # person_id as strings
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+
+def _write_part(cache_dir, df, parts, like=None):
+    # Parts are never overwritten, the manifest decides which ones make up the table. df is in partition order,
+    # its files take the schema of like (the stored table) or of df.
+    number = max([int(part[5:]) for part in parts], default=-1) + 1
+    part = f'part-{number:05d}'
+    os.makedirs(os.path.join(cache_dir, part), exist_ok=True)
+    schema = _table_schema(df if like is None else like)
+    for (platform, year), rows in df.groupby([df['platform'], df['datetime'].dt.year], observed=True).indices.items():
+        _write_parquet(df.iloc[rows], os.path.join(cache_dir, part, f'{platform}-{year}.parquet'), schema)
+    os.makedirs(os.path.join(cache_dir, part, ROLLUPS_DIR), exist_ok=True)
+    for granularity in ROLLUP_GRANULARITIES:
+        rollup = build_rollup(df, granularity)
+        _write_parquet(rollup, os.path.join(cache_dir, part, ROLLUPS_DIR, f'{granularity}.parquet'),
+                       _table_schema(rollup))
+    sketches = build_response_time_sketches(df)
+    _write_parquet(sketches, os.path.join(cache_dir, part, ROLLUPS_DIR, SKETCHES_FILE), _table_schema(sketches))
+    return part
+
+
+def _remove_unlisted_parts(cache_dir, parts):
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith('part-') and file_name not in parts:
+            path = os.path.join(cache_dir, file_name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+@stage
+def load_msg_df(telegram_file='data/telegram.json', whatsapp_folder='data/whatsapp', cache_dir='data/.cache',
+                workers=1, incremental=True, with_content=True, read=True, owner=OWNER, platforms=None, years=None,
+                remove_parts=True):
+    # with_content=False leaves msg_content on disk, see load_msg_content. read=False only brings the parts up
+    # to date and doesn't read them when they already are, for readers of msg_part_paths. platforms and years
+    # (an inclusive range) restrict the rows returned to those partitions. Either export may be missing.
+    # remove_parts=False keeps the parts a rewrite replaces, for snapshots still reading them (see
+    # remove_unlisted_parts).
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = _read_manifest(cache_dir)
+    manifest.setdefault('parts', [])
+
+    sources = []
+    if telegram_file and os.path.exists(telegram_file):
+        sources.append(('telegram', telegram_file, (telegram_file,)))
+    if whatsapp_folder and os.path.isdir(whatsapp_folder):
+        sources += [('whatsapp', zip_path, (zip_path, chat_name, chat_id))
+                    for zip_path, chat_name, chat_id in whatsapp_archives(whatsapp_folder)]
+    fingerprints = {path: source_fingerprint(path, manifest['sources'].get(path)) for _, path, _ in sources}
+    for kind, path, args in sources:
+        fingerprints[path].update(file=_source_file(path), chat_id=args[2] if kind == 'whatsapp' else None,
+                                  version=COMBINED_VERSION)
+    # Who counts as the owner decides sent and received, so it is part of the key
+    owner_key = [sorted(name.lower() for name in owner['names']), sorted(owner.get('telegram_ids', []))]
+    combined_key = hashlib.sha1(json.dumps([(path, fingerprints[path]['sha1']) for _, path, _ in sources] +
+                                           [owner_key]).encode('utf-8')).hexdigest()
+
+    current = manifest.get('version') == COMBINED_VERSION
+    if current and manifest['combined'] == combined_key and manifest['parts']:
+        # Remember touched-but-unchanged files so they aren't hashed again next time
+        sources_manifest = {path: fingerprint for path, fingerprint in fingerprints.items()
+                            if path in manifest['sources']}
+        if sources_manifest != manifest['sources']:
+            _write_manifest(cache_dir, dict(manifest, sources=sources_manifest))
+        if not read:
+            return None
+        columns = None if with_content else [column for column in manifest['columns'] if column != 'msg_content']
+        return _read_parts(cache_dir, manifest['parts'], columns, platforms, years)
+
+    # Only sources whose content changed are parsed again
+    frames, stale = {}, []
+    for kind, path, args in sources:
+        cached = manifest['sources'].get(path)
+        source_path = os.path.join(cache_dir, _source_file(path))
+        if (cached and cached['sha1'] == fingerprints[path]['sha1'] and cached.get('version') == COMBINED_VERSION
+                and os.path.exists(source_path)):
+            frames[path] = pd.read_parquet(source_path)
+        else:
+            stale.append((kind, path, args))
+
+    if workers == 1:
+        parsed = [_parse_source(kind, args) for kind, _, args in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_parse_source, kind, args) for kind, _, args in stale]
+            parsed = [future.result() for future in futures]
+    for (_, path, _), frame in zip(stale, parsed):
+        frames[path] = frame
+        if frame is not None:
+            _write_parquet(frame, os.path.join(cache_dir, _source_file(path)))
+    owner = resolve_owner(owner, next((path for kind, path, _ in sources if kind == 'telegram'), None))
+
+    # Appending is only possible when no source went away and no WhatsApp chat id shifted
+    can_append = incremental and current and stale and manifest['parts'] and all(
+        path in fingerprints and fingerprints[path]['chat_id'] == fingerprint.get('chat_id')
+        for path, fingerprint in manifest['sources'].items())
+
+    parts = manifest['parts']
+    if can_append:
+        msg_df = _read_parts(cache_dir, parts)
+        new_frames = [frames[path] for kind, path, _ in stale if kind == 'telegram']
+        if any(kind == 'whatsapp' for kind, _, _ in stale):
+            new_frames.append(merge_whatsapp_dfs(frames[path] for kind, path, _ in stale if kind == 'whatsapp'))
+        new_messages = _partition_order(find_new_messages(msg_df, pd.concat(new_frames, ignore_index=True), owner))
+        retyped_df = retype_chats(msg_df, new_messages)
+        combined_df = pd.concat([retyped_df, new_messages], ignore_index=True)
+        if retyped_df is msg_df and len(parts) < MAX_PARTS:
+            if not new_messages.empty:
+                parts = parts + [_write_part(cache_dir, new_messages, parts, like=msg_df)]
+        else:
+            combined_df = _partition_order(combined_df)
+            parts = [_write_part(cache_dir, combined_df, parts)]
+    else:
+        # WhatsApp chat ids are positional, re-stamp them in case archives were added or removed
+        whatsapp_frames = [frames[path].assign(chat_id=args[2]) for kind, path, args in sources
+                           if kind == 'whatsapp' and frames[path] is not None]
+        telegram_df = next((frames[path] for kind, path, _ in sources if kind == 'telegram'), None)
+        combined_df = _partition_order(combine_msg_dfs(telegram_df, merge_whatsapp_dfs(whatsapp_frames), owner))
+        parts = [_write_part(cache_dir, combined_df, parts)]
+
+    _write_manifest(cache_dir, {
+        'sources': {path: fingerprints[path] for _, path, _ in sources if frames[path] is not None},
+        'combined': combined_key,
+        'parts': parts,
+        'columns': list(combined_df.columns),
+        'version': COMBINED_VERSION,
+        # What the dashboard needs before it reads any partition
+        'chats': combined_df[CHAT_COLUMNS].drop_duplicates().dropna().to_dict('records'),
+        'last_datetime': combined_df['datetime'].max().isoformat() if len(combined_df) else None,
+    })
+    if remove_parts:
+        _remove_unlisted_parts(cache_dir, parts)
+    if platforms is not None or years is not None:
+        combined_df = combined_df[_in_partitions(combined_df, platforms, years)].reset_index(drop=True)
+    return combined_df if with_content else combined_df.drop(columns=['msg_content'])
+
+
+def load_user_msg_df(user, **kwargs):
+    # load_msg_df over the exports and the store of a user of users.py
+    return load_msg_df(user['telegram'], user['whatsapp'], user['cache_dir'], owner=user, **kwargs)
+
+
+def write_shared_table(df, path):
+    # Uncompressed so that readers can map the columns instead of decoding them
+    tmp_path = _tmp_path(path)
+    feather.write_feather(df, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def map_shared_table(path):
+    # Fixed-width columns are zero-copy views of the mapped file, so every process reading the same
+    # file shares its pages through the OS page cache instead of holding a private copy
+    return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+
+
+def write_shared_version(path, version):
+    # Written once every table published next to path is in place, workers reload when it changes
+    tmp_path = _tmp_path(path + '.version')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(tmp_path, path + '.version')
+
+
+def shared_version(path):
+    # Data version of the tables published next to path, None before the first publish
+    try:
+        with open(path + '.version', 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def data_version(cache_dir='data/.cache'):
+    # Changes whenever the content of any source or the layout of the combined frame changes
+    manifest = _read_manifest(cache_dir)
+    return f"{manifest['combined']}-{manifest.get('version', 1)}"
+
+
+def remove_unlisted_parts(cache_dir='data/.cache'):
+    # Removes the parts left behind by load_msg_df(remove_parts=False) once no snapshot reads them
+    _remove_unlisted_parts(cache_dir, _read_manifest(cache_dir)['parts'])
+
+
+def store_snapshot(cache_dir='data/.cache'):
+    # The stored table as it is now: its version, its parts, and what the dashboard needs before it reads any of
+    # them. Later ingests leave these parts alone until remove_unlisted_parts.
+    manifest = _read_manifest(cache_dir)
+    last = manifest.get('last_datetime')
+    return {
+        'cache_dir': cache_dir,
+        'version': f"{manifest['combined']}-{manifest.get('version', 1)}",
+        'parts': manifest['parts'],
+        'columns': manifest.get('columns', []),
+        'chats': pd.DataFrame(manifest.get('chats', []), columns=CHAT_COLUMNS),
+        'last_datetime': pd.Timestamp(last) if last else None,
+    }
+
+
+def snapshot_paths(snapshot, platforms=None, years=None):
+    # The Parquet files of a snapshot, in row order
+    return [os.path.abspath(path) for path in _part_files(snapshot['cache_dir'], snapshot['parts'], platforms, years)]
+
+
+def read_snapshot(snapshot, with_content=True, platforms=None, years=None, columns=None):
+    # The rows of a snapshot, like load_msg_df without ingesting anything. columns reads only those columns.
+    if columns is None and not with_content:
+        columns = [column for column in snapshot['columns'] if column != 'msg_content']
+    return _read_parts(snapshot['cache_dir'], snapshot['parts'], columns, platforms, years)
+
+
+def snapshot_rollup_paths(snapshot, granularity):
+    # The rollup files of a snapshot at granularity, one per part
+    return [os.path.abspath(os.path.join(snapshot['cache_dir'], part, ROLLUPS_DIR, f'{granularity}.parquet'))
+            for part in snapshot['parts']]
+
+
+def read_rollup(snapshot, granularity, platforms=None, years=None):
+    # The rollup of a snapshot's messages at granularity, the rollups of its parts added up
+    rollup = merge_rollups([pd.read_parquet(path) for path in snapshot_rollup_paths(snapshot, granularity)],
+                           granularity)
+    if platforms is not None or years is not None:
+        rollup = rollup[_in_partitions(rollup, platforms, years)].reset_index(drop=True)
+    return rollup
+
+
+def snapshot_sketch_paths(snapshot):
+    # The response time sketch files of a snapshot, one per part
+    return [os.path.abspath(os.path.join(snapshot['cache_dir'], part, ROLLUPS_DIR, SKETCHES_FILE))
+            for part in snapshot['parts']]
+
+
+def read_sketches(snapshot, platforms=None, years=None):
+    # The response time sketches of a snapshot's messages, the sketches of its parts added up
+    sketches = sum_sketches([pd.read_parquet(path) for path in snapshot_sketch_paths(snapshot)])
+    if platforms is not None or years is not None:
+        sketches = sketches[_in_partitions(sketches, platforms, years)].reset_index(drop=True)
+    return sketches
+
+
+def msg_part_paths(cache_dir='data/.cache', platforms=None, years=None):
+    # The Parquet files holding the combined frame, in row order
+    return snapshot_paths(store_snapshot(cache_dir), platforms, years)
+
+
+def load_msg_content(cache_dir='data/.cache', platforms=None, years=None):
+    # Message bodies in the same row order as load_msg_df, read on demand
+    return _read_parts(cache_dir, _read_manifest(cache_dir)['parts'], ['msg_content'], platforms,
+                       years)['msg_content']
+
+
+if __name__ == '__main__':
+    df = load_msg_df()
+    print(df.head())
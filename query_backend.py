@@ -0,0 +1,200 @@
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from aggregates import (RESPONSE_TIME_BINS, RESPONSE_TIME_COLUMNS, ROLLUP_GRANULARITIES, build_message_cube,
+                        build_response_time_sketches, build_rollup)
+from instrumentation import stage
+from io_utils import compact_msg_df
+from msg_index import MessageIndex
+from msg_store import (load_user_msg_df, read_rollup, read_sketches, read_snapshot, snapshot_paths,
+                       snapshot_rollup_paths, snapshot_sketch_paths, store_snapshot)
+from users import load_users
+
+# Where the dashboard's tables live. Both backends serve the hourly cube, the response time sketches and the trend
+# rollups (tables rollup_day, rollup_week and rollup_month, see aggregates) and filter them the same way,
+# single_plots builds the figures from what they return.
+#   pandas  the reference, both tables in memory and filtered through a MessageIndex
+#   duckdb  both tables in a DuckDB file, aggregated by SQL straight from the Parquet parts of msg_store, so the
+#           message table never goes through pandas and a query only returns the rows it selects
+# Pick one with TEXTINGWRAPPED_BACKEND, benchmarks/backend_equivalence.py checks that they agree. Every user of
+# users.py has their own backend.
+
+BACKEND_ENV = 'TEXTINGWRAPPED_BACKEND'
+BACKENDS = ['pandas', 'duckdb']
+CHAT_COLUMNS = ['chat_name', 'platform', 'chat_id', 'chat_type']
+TABLE_ORDER = {
+    'cube': ['datetime', 'platform', 'chat_id', 'chat_name', 'chat_type', 'sent'],
+    'sketches': ['datetime', 'platform', 'chat_id', 'chat_name', 'chat_type', 'sent', 'bucket'],
+}
+TABLE_ORDER.update({f'rollup_{granularity}': TABLE_ORDER['cube'] for granularity in ROLLUP_GRANULARITIES})
+
+
+class PandasBackend:
+    def __init__(self, cube, sketches, rollups):
+        # rollups maps each granularity to its rollup
+        self.tables = {'cube': cube, 'sketches': sketches}
+        self.tables.update({f'rollup_{granularity}': rollup for granularity, rollup in rollups.items()})
+        self.indexes = {table: MessageIndex(df) for table, df in self.tables.items()}
+
+    @classmethod
+    def from_msg_df(cls, msg_df, rollups=None, sketches=None):
+        # The rollups and sketches stored by msg_store when given, built from msg_df otherwise
+        compact = compact_msg_df(msg_df)
+        if rollups is None:
+            rollups = {granularity: build_rollup(compact, granularity) for granularity in ROLLUP_GRANULARITIES}
+        if sketches is None:
+            sketches = build_response_time_sketches(compact)
+        return cls(build_message_cube(compact), sketches, rollups)
+
+    def query(self, table, start_date, end_date, platforms, chat_type, chat_id=None):
+        return self.indexes[table].query(start_date, end_date, platforms, chat_type, chat_id)
+
+    def chats(self):
+        return self.tables['cube'][CHAT_COLUMNS].drop_duplicates().dropna()
+
+    def last_datetime(self):
+        return self.tables['cube']['datetime'].max()
+
+
+def _cube_sql(seconds_per_unit):
+    # Same rows and columns as build_message_cube, response time bins are [low, high) like pd.cut(right=False)
+    rt_seconds = f'response_time * {seconds_per_unit!r}'
+    rt_columns = ',\n'.join(
+        f'count(*) FILTER (WHERE {rt_seconds} >= {low} AND {rt_seconds} < {high})::INTEGER AS "{column}"'
+        for column, low, high in zip(RESPONSE_TIME_COLUMNS, RESPONSE_TIME_BINS[:-1], RESPONSE_TIME_BINS[1:]))
+    return f"""
+        SELECT date_trunc('hour', datetime) AS datetime,
+               hour(datetime)::TINYINT AS hour,
+               (isodow(datetime) - 1)::TINYINT AS weekday,
+               platform, chat_id, chat_name, chat_type, sent,
+               NOT sent AS received,
+               count(*)::BIGINT AS message_count,
+               sum(word_count)::BIGINT AS word_count,
+               {rt_columns}
+        FROM read_parquet(?)
+        GROUP BY ALL
+        ORDER BY {', '.join(TABLE_ORDER['cube'])}
+    """
+
+
+def _sketches_sql():
+    # Same rows and columns as msg_store.read_sketches: the sketches stored with every part added up
+    return f"""
+        SELECT datetime, platform, chat_id, chat_name, chat_type, sent, bucket,
+               sum(count)::INTEGER AS count
+        FROM read_parquet(?)
+        GROUP BY ALL
+        ORDER BY {', '.join(TABLE_ORDER['sketches'])}
+    """
+
+
+def _rollup_sql():
+    # Same rows and columns as msg_store.read_rollup: the rollups stored with every part added up
+    return f"""
+        SELECT datetime, platform, chat_id, chat_name, chat_type, sent,
+               NOT sent AS received,
+               sum(message_count)::BIGINT AS message_count,
+               sum(word_count)::BIGINT AS word_count,
+               granularity
+        FROM read_parquet(?)
+        GROUP BY ALL
+        ORDER BY {', '.join(TABLE_ORDER['cube'])}
+    """
+
+
+class DuckDBBackend:
+    def __init__(self, path, parts=None, version=None, rollups=None, sketches=None):
+        # Rebuilds the tables from parts, rollups (granularity -> rollup files) and sketches (sketch files) when the
+        # file holds another data version
+        import duckdb
+        self.connection = duckdb.connect(path)
+        if parts is not None and self.version() != version:
+            self.build(parts, version, rollups, sketches)
+
+    def version(self):
+        tables = self.connection.execute("SELECT table_name FROM information_schema.tables").fetchall()
+        if ('meta',) not in tables:
+            return None
+        return self.connection.execute("SELECT version FROM meta").fetchone()[0]
+
+    @stage(name='query_backend.DuckDBBackend.build')
+    def build(self, parts, version, rollups, sketches):
+        # The SQL of each table reads the file list bound to its only parameter, paths never go into the SQL text.
+        # Durations are stored as integers in the unit of the Arrow type.
+        unit = pq.read_schema(parts[0]).field('response_time').type.unit
+        seconds_per_unit = {'s': 1.0, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}[unit]
+        self.connection.execute("BEGIN TRANSACTION")
+        self.connection.execute("CREATE OR REPLACE TABLE cube AS " + _cube_sql(seconds_per_unit), [list(parts)])
+        self.connection.execute("CREATE OR REPLACE TABLE sketches AS " + _sketches_sql(), [list(sketches)])
+        for granularity, paths in rollups.items():
+            self.connection.execute(f"CREATE OR REPLACE TABLE rollup_{granularity} AS " + _rollup_sql(), [list(paths)])
+        self.connection.execute("CREATE OR REPLACE TABLE meta AS SELECT ? AS version", [version])
+        self.connection.execute("COMMIT")
+
+    @stage(name='query_backend.DuckDBBackend.query')
+    def query(self, table, start_date, end_date, platforms, chat_type, chat_id=None):
+        # The same rows as MessageIndex.query, the whole end day included
+        sql = (f"SELECT * FROM {table} WHERE datetime >= ? AND datetime < ? AND list_contains(?, platform) "
+               f"AND chat_type = ?")
+        params = [pd.Timestamp(start_date).to_pydatetime(),
+                  (pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)).to_pydatetime(),
+                  list(platforms), chat_type]
+        if chat_id:
+            sql += " AND chat_id = ?"
+            params.append(int(chat_id))
+        sql += f" ORDER BY {', '.join(TABLE_ORDER[table])}"
+        return self._df(sql, params)
+
+    def chats(self):
+        return self._df(f"SELECT DISTINCT {', '.join(CHAT_COLUMNS)} FROM cube").dropna()
+
+    def last_datetime(self):
+        return self._df("SELECT max(datetime) AS datetime FROM cube")['datetime'].iloc[0]
+
+    def _df(self, sql, params=()):
+        # A cursor per query, so that callbacks running in threads can share the connection
+        cursor = self.connection.cursor()
+        try:
+            return cursor.execute(sql, list(params)).df()
+        finally:
+            cursor.close()
+
+
+def backend_name(name=None):
+    name = name or os.environ.get(BACKEND_ENV, 'pandas')
+    if name not in BACKENDS:
+        raise ValueError(f'unknown query backend {name!r}, expected one of {BACKENDS}')
+    return name
+
+
+def open_backend(name=None, user=None, years=None, snapshot=None):
+    # The backend named by name or TEXTINGWRAPPED_BACKEND (pandas by default), over the messages of user (a
+    # config of users.py, the first registered user by default) as of snapshot (see msg_store.store_snapshot,
+    # the user's exports are ingested first when there is none). A pandas backend only reads the partitions of
+    # years (an inclusive range, all of them by default), DuckDB aggregates every partition once and filters
+    # dates in SQL. DuckDB files are opened for writing, so they serve a single process: serve.py publishes
+    # pandas tables.
+    name = backend_name(name)
+    if snapshot is None:
+        user = user or next(iter(load_users().values()))
+        load_user_msg_df(user, read=False)
+        snapshot = store_snapshot(user['cache_dir'])
+    if name == 'pandas':
+        rollups = {granularity: read_rollup(snapshot, granularity, years=years) for granularity in ROLLUP_GRANULARITIES}
+        return PandasBackend.from_msg_df(read_snapshot(snapshot, with_content=False, years=years), rollups,
+                                         read_sketches(snapshot, years=years))
+    # One file per data version, so that a backend opened for an older snapshot keeps answering for it
+    cache_dir = snapshot['cache_dir']
+    file_name = f"messages-{snapshot['version']}.duckdb"
+    backend = DuckDBBackend(os.path.join(cache_dir, file_name), snapshot_paths(snapshot), snapshot['version'],
+                            {granularity: snapshot_rollup_paths(snapshot, granularity)
+                             for granularity in ROLLUP_GRANULARITIES}, snapshot_sketch_paths(snapshot))
+    for old_file in os.listdir(cache_dir):
+        if old_file.startswith('messages') and '.duckdb' in old_file and not old_file.startswith(file_name):
+            try:
+                os.remove(os.path.join(cache_dir, old_file))
+            except OSError:
+                pass
+    return backend
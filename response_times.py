@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+# Replies and conversations, per chat. A message is a reply when the message before it in the same chat came
+# from someone else (told apart by (platform, person_id) where the export has ids, by name otherwise), its response_time is the time since that message (NaT for every other message), and
+# reply_to_owner tells whether that message was the owner's.
+# A silence longer than the idle gap starts a new conversation, session numbers them from 0 within each chat.
+
+CHAT_KEYS = ['platform', 'chat_id']
+SESSION_GAP = pd.Timedelta(hours=6)
+
+
+def reply_arrays(chat, sender, sent, times, session_gap=SESSION_GAP):
+    # One pass over arrays sorted by chat then time: chat and sender are integer codes, sent flags the owner's
+    # messages and times is datetime64[ns]. Returns the response times, whether each message replies to the
+    # owner, the session of every message and the position of the first message of its chat.
+    n = len(times)
+    not_a_time = np.timedelta64('NaT', 'ns')
+    if n == 0:
+        return (np.array([], dtype='timedelta64[ns]'), np.array([], dtype=bool), np.array([], dtype='int64'),
+                np.array([], dtype='int64'))
+
+    new_chat = np.ones(n, dtype=bool)
+    new_chat[1:] = chat[1:] != chat[:-1]
+    gap = np.full(n, not_a_time)
+    gap[1:] = times[1:] - times[:-1]
+    gap[new_chat] = not_a_time
+
+    is_reply = np.zeros(n, dtype=bool)
+    is_reply[1:] = sender[1:] != sender[:-1]
+    is_reply &= ~new_chat
+    response_time = np.where(is_reply, gap, not_a_time)
+    reply_to_owner = np.zeros(n, dtype=bool)
+    reply_to_owner[1:] = is_reply[1:] & sent[:-1]
+
+    new_session = new_chat | (gap > pd.Timedelta(session_gap).to_timedelta64())
+    sessions = np.cumsum(new_session)
+    chat_start = np.maximum.accumulate(np.where(new_chat, np.arange(n), 0))
+    return response_time, reply_to_owner, sessions - sessions[chat_start], chat_start
+
+
+def sender_codes(frame):
+    # One integer per sender: Telegram members are told apart by their id, so namesakes stay apart and a renamed
+    # member stays one sender. WhatsApp exports only have names.
+    if 'person_id' not in frame:
+        return pd.factorize(frame['person_name'])[0]
+    by_id = frame.groupby(['platform', 'person_id'], sort=False, observed=True).ngroup().to_numpy()
+    has_id = ~np.isnan(by_id)
+    by_name = pd.factorize(frame['person_name'])[0]
+    return np.where(has_id, by_id, np.nanmax(by_id, initial=-1) + 1 + by_name).astype('int64')
+
+
+@stage
+def add_response_times(msg_df, session_gap=SESSION_GAP, previous=None):
+    # Returns a copy of msg_df (with sent) sorted by (platform, chat_id, datetime) with response_time,
+    # reply_to_owner and session.
+    # previous holds the last stored message of each chat (with its session) when msg_df continues a stored
+    # table, the first new message of a chat then replies to it and carries on its session numbering.
+    msg_df = msg_df.sort_values(by=CHAT_KEYS + ['datetime'], kind='stable')
+    senders = [column for column in ['person_name', 'person_id'] if column in msg_df]
+    frame = msg_df[CHAT_KEYS + ['datetime', 'sent'] + senders].assign(session=0, stored=False)
+    if previous is not None:
+        # Stored messages are never later than the new ones of their chat, the stable sort keeps them first
+        senders = [column for column in ['person_name', 'person_id'] if column in previous]
+        stored = previous[CHAT_KEYS + ['datetime', 'sent', 'session'] + senders].assign(stored=True)
+        frame = pd.concat([stored, frame]).sort_values(by=CHAT_KEYS + ['datetime'], kind='stable')
+
+    chat = frame.groupby(CHAT_KEYS, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    sender = sender_codes(frame)
+    response_time, reply_to_owner, session, chat_start = reply_arrays(
+        chat, sender, frame['sent'].to_numpy(bool), frame['datetime'].to_numpy('datetime64[ns]'), session_gap)
+    session += frame['session'].to_numpy()[chat_start]
+
+    is_new = ~frame['stored'].to_numpy()
+    msg_df['response_time'] = response_time[is_new]
+    msg_df['reply_to_owner'] = reply_to_owner[is_new]
+    msg_df['session'] = session[is_new].astype('int32')
+    return msg_df
@@ -0,0 +1,120 @@
+# Production entry point: the message data of every user is loaded once here, published as memory-mapped cubes
+# and response time sketches, and served by a multi-worker gunicorn.
+#   python serve.py --workers 4 --bind 0.0.0.0:8050
+# With another WSGI server, run "python serve.py --publish-only" and point it at dashboard:server with
+# TEXTINGWRAPPED_SHARED_CUBE, TEXTINGWRAPPED_SHARED_SKETCHES and TEXTINGWRAPPED_SHARED_ROLLUPS set to the printed
+# paths ({user} and {granularity} included).
+# Every TEXTINGWRAPPED_REFRESH_INTERVAL seconds the exports are ingested again and the tables of users with newer
+# messages republished, the workers then swap them in.
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+from gunicorn.app.base import BaseApplication
+
+from aggregates import build_message_cube, ROLLUP_GRANULARITIES
+from facts import load_facts
+from io_utils import compact_msg_df
+from msg_store import (data_version, load_user_msg_df, read_rollup, read_sketches, shared_version, store_snapshot,
+                       write_shared_table, write_shared_version, DEFAULT_REFRESH_INTERVAL, REFRESH_INTERVAL_ENV, SHARED_CUBE_ENV,
+                       SHARED_ROLLUPS_ENV, SHARED_SKETCHES_ENV)
+from users import load_users, CACHE_ROOT
+
+logger = logging.getLogger(__name__)
+
+CUBE_PATH = os.path.join(CACHE_ROOT, 'users', '{user}', 'cube.feather')
+SKETCHES_PATH = os.path.join(CACHE_ROOT, 'users', '{user}', 'rt_sketches.feather')
+ROLLUPS_PATH = os.path.join(CACHE_ROOT, 'users', '{user}', 'rollup-{granularity}.feather')
+
+
+def publish_user(user, config, cube_path=CUBE_PATH, sketches_path=SKETCHES_PATH, rollups_path=ROLLUPS_PATH):
+    # The facts of the user are brought up to date too, workers only read them. The version marker goes last, a
+    # worker seeing it finds everything of that version in place.
+    msg_df = load_user_msg_df(config, with_content=False)
+    if msg_df.empty:
+        # Nothing to serve before the user's first export, the dashboard doesn't ask for their tables
+        return
+    snapshot = store_snapshot(config['cache_dir'])
+    write_shared_table(build_message_cube(compact_msg_df(msg_df)), cube_path.format(user=user))
+    write_shared_table(read_sketches(snapshot), sketches_path.format(user=user))
+    for granularity in ROLLUP_GRANULARITIES:
+        write_shared_table(read_rollup(snapshot, granularity), rollups_path.format(user=user, granularity=granularity))
+    load_facts(config, snapshot)
+    write_shared_version(cube_path.format(user=user), data_version(config['cache_dir']))
+
+
+def publish_tables(cube_path=CUBE_PATH, sketches_path=SKETCHES_PATH, rollups_path=ROLLUPS_PATH):
+    # {user} in the paths is replaced by each user's name
+    for user, config in load_users().items():
+        publish_user(user, config, cube_path, sketches_path, rollups_path)
+    os.environ[SHARED_CUBE_ENV] = os.path.abspath(cube_path)
+    os.environ[SHARED_SKETCHES_ENV] = os.path.abspath(sketches_path)
+    os.environ[SHARED_ROLLUPS_ENV] = os.path.abspath(rollups_path)
+    return cube_path, sketches_path, rollups_path
+
+
+def refresh_tables(interval, cube_path=CUBE_PATH, sketches_path=SKETCHES_PATH, rollups_path=ROLLUPS_PATH):
+    # Runs in its own process next to the gunicorn master. Workers keep the tables they mapped until they see the
+    # new version marker, replaced files stay readable until then.
+    users = load_users()
+    while True:
+        time.sleep(interval)
+        for user, config in users.items():
+            try:
+                load_user_msg_df(config, read=False)
+                if data_version(config['cache_dir']) != shared_version(cube_path.format(user=user)):
+                    publish_user(user, config, cube_path, sketches_path, rollups_path)
+                    logger.info("republished the tables of %s", user)
+            except Exception:
+                logger.exception("refreshing %s failed", user)
+
+
+class DashboardApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Imported in each worker, after the tables have been published
+        from dashboard import app, start_loader
+        start_loader()
+        return app.server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--bind', default='0.0.0.0:8050')
+    parser.add_argument('--timeout', type=int, default=120)
+    parser.add_argument('--publish-only', action='store_true')
+    parser.add_argument('--refresh', type=float,
+                        default=float(os.environ.get(REFRESH_INTERVAL_ENV, DEFAULT_REFRESH_INTERVAL)),
+                        help='seconds between two ingests of the exports, 0 to publish once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    paths = publish_tables()
+    if args.publish_only:
+        for path in paths:
+            print(os.path.abspath(path))
+        return
+    if args.refresh > 0:
+        # Forked before gunicorn starts its workers, and stopped with the master
+        multiprocessing.Process(target=refresh_tables, args=(args.refresh,), daemon=True).start()
+    DashboardApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'timeout': args.timeout,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
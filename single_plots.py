@@ -1,11 +1,12 @@
-from io_utils import msg2df
+from io_utils import WEEKDAYS
+from aggregates import (RESPONSE_TIME_LABELS, RESPONSE_TIME_COLUMNS, SKETCH_BASE, response_time_bin_codes,
+                        build_response_time_sketches, build_rollup, merge_sketches, sketch_quantile)
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from datetime import datetime as dt
 import plotly.io as pio
 import plotly.graph_objects as go
-import plotly.figure_factory as ff
-from scipy.ndimage import gaussian_filter1d
 
 
 # Customizing the plotly template
@@ -27,38 +28,72 @@ pio.templates["solar_custom"] = go.layout.Template(
 # Set the custom template as default
 pio.templates.default = "solar_custom"
 
+# scipy takes longer to import than everything above, it is imported by the builder that needs it
+
+# Figures are built from counts binned here, never from message rows, so their size depends on the number of
+# bins and not on the length of the history. Time series switch to a coarser period past MAX_LINE_POINTS.
+MAX_LINE_POINTS = 120
+LINE_PERIODS = [('M', 'Month'), ('Q', 'Quarter'), ('Y', 'Year')]
+# The trend figure reads the coarsest rollup (see aggregates.build_rollup) that still gives MIN_TREND_POINTS points
+# over the date range: days under 16 weeks, weeks under 16 months, months beyond. A query then returns at most
+# ~16 weeks of days or ~16 months of weeks per chat, and a month per chat for longer ranges.
+MIN_TREND_POINTS = 16
+ROLLUP_DAYS = {'day': 1, 'week': 7, 'month': 365.25 / 12}
+# Periods finer than LINE_PERIODS a rollup can be shown in
+TREND_PERIODS = {'day': [('D', 'Day'), ('W', 'Week')], 'week': [('W', 'Week')], 'month': []}
+
+# The builders never write to the frame they are given, groupings are passed as key arrays
+# (columns or values derived from them) so callers can share one filtered or cached frame.
+
+def _message_counts(msg_df, by):
+    # Messages per group: a raw message counts once, a row of the aggregate cube stands for message_count messages
+    if 'message_count' in msg_df:
+        return msg_df['message_count'].groupby(by, observed=True).sum()
+    return msg_df['sent'].groupby(by, observed=True).size()
+
+
+def _sent_received(msg_df, by):
+    # Number of sent and received messages per group
+    counts = _message_counts(msg_df, by + [msg_df['sent']]).unstack('sent', fill_value=0)
+    counts = counts.reindex(columns=[True, False], fill_value=0)
+    counts.columns = ['sent', 'received']
+    return counts
+
+
+def _day_of_the_week(msg_df):
+    # Compact frames carry a weekday code instead of the name
+    if 'weekday' in msg_df:
+        return pd.Series(pd.Categorical.from_codes(msg_df['weekday'], WEEKDAYS), index=msg_df.index,
+                         name='day_of_the_week')
+    return msg_df['day_of_the_week']
+
+
 def weekday_histogram(msg_df):
-    # Group by day_of_the_week and platform, and count sent and received messages
-    weekday_msg = msg_df.groupby(['day_of_the_week', 'platform']).agg(
-        sent=('sent', 'sum'),
-        received=('received', 'sum')
-    ).reset_index()
+    # Group by day_of_the_week, and count sent and received messages
+    weekday_msg = _sent_received(msg_df, [_day_of_the_week(msg_df)]).reset_index()
 
     # Melt the dataframe to have a long format suitable for Plotly
-    weekday_msg_melted = weekday_msg.melt(id_vars=['day_of_the_week', 'platform'],
+    weekday_msg_melted = weekday_msg.melt(id_vars=['day_of_the_week'],
                                           value_vars=['sent', 'received'],
                                           var_name='message_type',
                                           value_name='count')
 
-    # Create the histogram with ordered days of the week
-    fig = px.histogram(weekday_msg_melted, x='day_of_the_week', y='count', color='message_type',
-                       category_orders={
-                           'day_of_the_week': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
-                                               'Sunday']},
-                       barmode='group', title='Messages Sent and Received per Day of the Week')
+    # Create the bar chart with ordered days of the week, one bar per count
+    fig = px.bar(weekday_msg_melted, x='day_of_the_week', y='count', color='message_type',
+                 category_orders={'day_of_the_week': WEEKDAYS},
+                 barmode='group', title='Messages Sent and Received per Day of the Week')
     fig.update_layout(xaxis_title="Day of The Week", yaxis_title="Total Message")
     return fig
 
 
 def hourly_lineplot(msg_df):
-    # Extract the hour from the datetime
-    msg_df['hour'] = msg_df['datetime'].dt.hour
+    from scipy.ndimage import gaussian_filter1d
+
+    # Extract the hour from the datetime, cube rows already carry it
+    hour = msg_df['hour'] if 'hour' in msg_df else msg_df['datetime'].dt.hour.rename('hour')
 
-    # Group by hour and platform, and count sent and received messages
-    hourly_msg = msg_df.groupby(['hour']).agg(
-        sent=('sent', 'sum'),
-        received=('received', 'sum')
-    ).reset_index()
+    # Group by hour, and count sent and received messages
+    hourly_msg = _sent_received(msg_df, [hour]).reset_index()
 
     # Apply Gaussian smoothing
     hourly_msg['sent'] = gaussian_filter1d(hourly_msg['sent'], sigma=0.5)
@@ -72,56 +107,62 @@ def hourly_lineplot(msg_df):
 
     return fig
 
-def response_time_distplot(msg_df):
-    # Calculate the 95th percentile of the response_time
-    percentile_95 = msg_df['response_time'].dt.total_seconds().quantile(0.01)
-
-    # Filter out the values above the 95th percentile
-    msg_df = msg_df[msg_df['response_time'].dt.total_seconds() <= percentile_95]
+def _response_time_sketches(msg_df):
+    # Sketch builders take the response time sketches of aggregates, a raw message frame is sketched first
+    return msg_df if 'bucket' in msg_df else build_response_time_sketches(msg_df)
 
-    # Filter sent and received messages
-    sent_response_times = msg_df[msg_df['sent']]['response_time'].dt.total_seconds().dropna().tolist()
-    received_response_times = msg_df[msg_df['received']]['response_time'].dt.total_seconds().dropna().tolist()
+def response_time_density_plot(msg_df):
+    # Share of replies per sketch bucket, merged over every chat and day of the filter
+    bucket_counts = merge_sketches(_response_time_sketches(msg_df), by=['sent'])
+    density = bucket_counts.div(bucket_counts.sum(axis=1), axis=0).round(5)
+    density_msg = (density.rename(index={True: 'Sent', False: 'Received'}).rename_axis(index='sent')
+                   .stack().rename('share').reset_index())
+    # Geometric middle of every bucket
+    density_msg['seconds'] = (SKETCH_BASE ** (density_msg['bucket'] + 0.5)).round(1)
 
-    # Create the distplot
-    fig = ff.create_distplot([sent_response_times, received_response_times], group_labels=['Sent', 'Received'],
-                             show_hist=False, colors=custom_colors['plot_colors'][:2])
-    fig.update_layout(title='Distribution of Response Time for Sent and Received Messages', xaxis_title='Response Time (seconds)', yaxis_title='Density')
+    # Create the line plot
+    fig = px.line(density_msg, x='seconds', y='share', color='sent',
+                  category_orders={'sent': ['Sent', 'Received']},
+                  title='Density of Response Time for Sent and Received Messages')
+    fig.update_layout(xaxis_title='Response Time (seconds)', yaxis_title='Share of Replies', xaxis_type='log')
 
     return fig
 
 def message_count_distplot(msg_df, min_messages=20, n_bins=50):
     # Group by chat_name and count the number of messages in each chat
-    chat_message_counts = msg_df.groupby(['platform', 'chat_name']).size().reset_index(name='message_count')
+    chat_message_counts = _message_counts(msg_df, [msg_df['platform'], msg_df['chat_name']]).reset_index(
+        name='message_count')
 
     # Filter out the chats with less than min_messages
     valid_chats = chat_message_counts[chat_message_counts['message_count'] >= min_messages]
 
+    # Bin the chats here, the figure only carries one bar per bin
+    chat_counts, edges = np.histogram(valid_chats['message_count'], bins=n_bins)
+
     # Create the histogram
-    fig = px.histogram(valid_chats, x='message_count', nbins=n_bins,
-                       title=f'Distribution of Message Counts per Chat (at least {min_messages} messages)',
-                       labels={'message_count': 'Number of Messages'},
-                       color_discrete_sequence=custom_colors['plot_colors'][:1])
-    fig.update_layout(xaxis_title="Number of Messages", yaxis_title="Count of Chats")
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=chat_counts, width=np.diff(edges),
+                           marker_color=custom_colors['plot_colors'][0], name='Chats'))
+    fig.update_layout(title=f'Distribution of Message Counts per Chat (at least {min_messages} messages)',
+                      xaxis_title="Number of Messages", yaxis_title="Count of Chats", bargap=0)
 
     return fig
 
 
 def top_10_message_count(msg_df):
     # Group by chat_name and count the number of messages in each chat
-    chat_message_counts = msg_df.groupby(['platform', 'chat_name']).size().reset_index(name='message_count')
-    top_10_chats = chat_message_counts.nlargest(10, 'message_count')
+    chat_message_counts = _message_counts(msg_df, [msg_df['platform'], msg_df['chat_name']]).reset_index(
+        name='message_count')
+    top_10_chats = chat_message_counts.nlargest(10, 'message_count').astype({'platform': str, 'chat_name': str})
 
     # Ensure unique chat_name by appending platform if there are duplicates
     duplicates = top_10_chats['chat_name'].duplicated(keep=False)
-    top_10_chats.loc[duplicates, 'chat_name'] = top_10_chats.loc[duplicates].apply(
-        lambda row: f"{row['chat_name']} ({row['platform']})", axis=1
-    )
+    chat_names = top_10_chats['chat_name'].where(~duplicates,
+                                                 top_10_chats['chat_name'] + ' (' + top_10_chats['platform'] + ')')
 
     # Create the bar chart
     fig = go.Figure()
     fig.add_trace(go.Bar(
-        x=top_10_chats['chat_name'],
+        x=chat_names,
         y=top_10_chats['message_count'],
         customdata=top_10_chats['platform'],
         text=top_10_chats['message_count'],
@@ -138,10 +179,7 @@ def top_10_message_count(msg_df):
 
 def messages_per_platform_histogram(msg_df):
     # Group by platform and count sent and received messages
-    platform_msg = msg_df.groupby(['platform']).agg(
-        sent=('sent', 'sum'),
-        received=('received', 'sum')
-    ).reset_index()
+    platform_msg = _sent_received(msg_df, [msg_df['platform']]).reset_index()
 
     # Melt the dataframe to have a long format suitable for Plotly
     platform_msg_melted = platform_msg.melt(id_vars=['platform'],
@@ -149,22 +187,23 @@ def messages_per_platform_histogram(msg_df):
                                             var_name='message_type',
                                             value_name='count')
 
-    # Create the histogram
-    fig = px.histogram(platform_msg_melted, x='platform', y='count', color='message_type',
-                       barmode='group', title='Messages Sent and Received per Platform')
+    # Create the bar chart
+    fig = px.bar(platform_msg_melted, x='platform', y='count', color='message_type',
+                 barmode='group', title='Messages Sent and Received per Platform')
     fig.update_layout(xaxis_title="Platform", yaxis_title="Total Messages")
     return fig
 
 
 def word_count_sent_received(msg_df):
-    # Add a column to indicate message type
-    msg_df['message_type'] = msg_df['sent'].apply(lambda x: 'sent' if x else 'received')
+    # Label each message with its type
+    message_type = pd.Series(np.where(msg_df['sent'], 'sent', 'received'), index=msg_df.index, name='message_type')
 
     # Group by platform and message type, and calculate total word count and number of messages
-    platform_msg = msg_df.groupby(['platform', 'message_type']).agg(
-        total_word_count=('word_count', 'sum'),
-        message_count=('word_count', 'count')
-    ).reset_index()
+    keys = [msg_df['platform'], message_type]
+    platform_msg = pd.DataFrame({
+        'total_word_count': msg_df['word_count'].groupby(keys, observed=True).sum(),
+        'message_count': _message_counts(msg_df, keys)
+    }).reset_index()
 
     # Calculate the average word count
     platform_msg['average_word_count'] = platform_msg['total_word_count'] / platform_msg['message_count']
@@ -178,24 +217,25 @@ def word_count_sent_received(msg_df):
 
 
 def response_time_distplot(msg_df):
-    # Define the bins and labels
-    bins = [0, 10, 60, 300, 1200, 3600, 18000, 43200, 172800, 604800, 2592000, 7776000, 15768000, 31536000, 94608000]
-    labels = ['0-10secs', '10-60secs', '1-5mins', '5-20mins', '20mins-1hr', '1-5hrs', '5-12hrs', '12hrs-2days',
-              '2days-1week', '1week-1month', '1month-3months', '3-6months', '6months-1year', '1year-3years']
-
-    # Create a new column for the binned response times
-    msg_df['response_time_bins'] = pd.cut(msg_df['response_time'].dt.total_seconds(), bins=bins, labels=labels, right=False)
-
-    # Map the boolean 'sent' column to 'Sent' and 'Received'
-    msg_df['sent'] = msg_df['sent'].map({True: 'Sent', False: 'Received'})
-
-    # Create the histogram
-    fig = px.histogram(
-        msg_df,
+    # Count messages per response time bin and direction, cube rows already hold the counts per bin
+    if 'message_count' in msg_df:
+        bin_counts = msg_df.groupby('sent')[RESPONSE_TIME_COLUMNS].sum()
+    else:
+        codes = response_time_bin_codes(msg_df['response_time'])
+        bin_counts = pd.crosstab(msg_df['sent'], codes).reindex(columns=range(len(RESPONSE_TIME_LABELS)), fill_value=0)
+    bin_counts.columns = RESPONSE_TIME_LABELS
+    response_time_msg = (bin_counts.rename(index={True: 'Sent', False: 'Received'})
+                         .rename_axis(index='sent', columns='response_time_bins')
+                         .stack().reset_index(name='count'))
+
+    # Create the bar chart, the bins are counted above
+    fig = px.bar(
+        response_time_msg,
         x='response_time_bins',
+        y='count',
         color='sent',
         title='Distribution of Response Time for Sent and Received Messages',
-        category_orders={'response_time_bins': labels, 'sent': ['Sent', 'Received']},
+        category_orders={'response_time_bins': RESPONSE_TIME_LABELS, 'sent': ['Sent', 'Received']},
         barmode='group'  # Set barmode to 'group' to place bins next to each other
 
     )
@@ -207,7 +247,70 @@ def response_time_distplot(msg_df):
 
     return fig
 
+def _line_period(datetimes, max_points=MAX_LINE_POINTS, periods=LINE_PERIODS):
+    # Finest of periods (month, quarter and year by default) that keeps a time series under max_points points
+    for period, name in periods:
+        if datetimes.dt.to_period(period).nunique() <= max_points:
+            return period, name
+    return periods[-1]
+
+def median_reply_time_lineplot(msg_df):
+    # Median reply time per month, merged from the daily response time sketches. Long histories are merged
+    # per quarter or year instead, so the figure never carries more than MAX_LINE_POINTS points per trace.
+    sketches = _response_time_sketches(msg_df)
+    period, period_name = _line_period(sketches['datetime'])
+    start = sketches['datetime'].dt.to_period(period).dt.to_timestamp().rename('period')
+    median = sketch_quantile(merge_sketches(sketches.assign(period=start), by=['period', 'sent']))
+    reply_msg = (median.div(60).round(2).rename('minutes').dropna().reset_index()
+                 .replace({'sent': {True: 'Sent', False: 'Received'}}))
+
+    # Create the line plot
+    fig = px.line(reply_msg, x='period', y='minutes', color='sent', markers=True,
+                  category_orders={'sent': ['Sent', 'Received']},
+                  title=f'Median Reply Time per {period_name}')
+    fig.update_layout(xaxis_title=period_name, yaxis_title="Median Reply Time (minutes)", yaxis_type='log')
+
+    return fig
+
+def trend_rollup(start_date, end_date, min_points=MIN_TREND_POINTS):
+    # Granularity of the rollup the trend figure reads for a date range, both ends included
+    days = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1
+    for granularity in ['month', 'week']:
+        if days / ROLLUP_DAYS[granularity] >= min_points:
+            return granularity
+    return 'day'
+
+def activity_trend_lineplot(msg_df):
+    # Messages sent and received and chats with at least one message per period, from a trend rollup. A raw
+    # message frame is rolled up first, at the granularity trend_rollup picks for its span.
+    if 'granularity' not in msg_df:
+        span = msg_df['datetime'].agg(['min', 'max']) if len(msg_df) else [pd.Timestamp(0)] * 2
+        msg_df = build_rollup(msg_df, trend_rollup(*span))
+    granularity = msg_df['granularity'].iloc[0] if len(msg_df) else 'day'
+
+    # Shown per period of the rollup, or per coarser one past MAX_LINE_POINTS points
+    period, period_name = _line_period(msg_df['datetime'], periods=TREND_PERIODS[granularity] + LINE_PERIODS)
+    start = msg_df['datetime'].dt.to_period(period).dt.to_timestamp().rename('period')
+    trend = _sent_received(msg_df, [start])
+    chats = msg_df[['platform', 'chat_id']].assign(period=start).drop_duplicates()
+    trend['active_chats'] = chats.groupby('period').size()
+
+    # Create the line plot, active chats on their own axis
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=trend.index, y=trend['sent'], name='Sent', mode='lines'))
+    fig.add_trace(go.Scatter(x=trend.index, y=trend['received'], name='Received', mode='lines'))
+    fig.add_trace(go.Scatter(x=trend.index, y=trend['active_chats'], name='Active Chats', mode='lines',
+                             line=dict(dash='dot'), yaxis='y2'))
+    fig.update_layout(title=f'Messages and Active Chats per {period_name}', xaxis_title=period_name,
+                      yaxis_title='Messages',
+                      yaxis2=dict(title='Active Chats', overlaying='y', side='right', rangemode='tozero'))
+
+    return fig
+
+
 if __name__ == '__main__':
+    from io_utils import msg2df
+
     msg_df = msg2df()
     # Filter only chats of type 'dm' and messages from the year 2025
     msg_df = msg_df[(msg_df['chat_type'] == 'dm') & (msg_df['datetime'].dt.year == 2024)]
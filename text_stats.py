@@ -0,0 +1,50 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Statistics of message bodies computed over whole Arrow arrays with pyarrow's regex kernels, one batched
+# pass per statistic instead of a Python call per message.
+
+# Everything str.split() splits on, so word_count stays len(text.split())
+WHITESPACE = (r'\t\n\x{0B}\f\r\x{1C}-\x{20}\x{85}\x{A0}\x{1680}\x{2000}-\x{200A}\x{2028}\x{2029}\x{202F}'
+              r'\x{205F}\x{3000}')
+WORD = f'[^{WHITESPACE}]+'
+LINK = r'(?i)(?:https?://|www\.)[^\s]'
+EMOJI = (r'[\x{1F000}-\x{1FAFF}\x{2600}-\x{27BF}\x{2300}-\x{23FF}\x{2B05}-\x{2B55}\x{3030}\x{303D}\x{3297}'
+         r'\x{3299}]')
+# Tokens of the frequency table are lower-cased runs of letters, digits, underscores and apostrophes
+TOKEN_SEPARATOR = r"[^\p{L}\p{N}_']+"
+
+
+def _arrow_text(msg_content):
+    return pa.array(msg_content, type=pa.string(), from_pandas=True)
+
+
+def text_stats(msg_content):
+    # word_count, char_count, has_link and has_emoji of every message body, indexed like msg_content
+    text = _arrow_text(msg_content)
+    return pd.DataFrame({
+        'word_count': pc.count_substring_regex(text, WORD).fill_null(0).to_numpy(),
+        'char_count': pc.utf8_length(text).fill_null(0).to_numpy(),
+        'has_link': pc.match_substring_regex(text, LINK).fill_null(False).to_numpy(zero_copy_only=False),
+        'has_emoji': pc.match_substring_regex(text, EMOJI).fill_null(False).to_numpy(zero_copy_only=False),
+    }, index=msg_content.index)
+
+
+def token_frequencies(msg_df, by=('platform', 'chat_id'), top=None):
+    # Occurrences of every token per group of by, most frequent first within each group. Media placeholders are
+    # left out, top keeps the top most frequent tokens of each group.
+    by = list(by)
+    if 'msg_type' in msg_df:
+        msg_df = msg_df[msg_df['msg_type'].eq('text')]
+    tokens = pc.split_pattern_regex(pc.utf8_lower(_arrow_text(msg_df['msg_content'])), TOKEN_SEPARATOR)
+    messages = pc.list_parent_indices(tokens)
+    table = pa.table({key: pa.array(msg_df[key].to_numpy(), from_pandas=True).take(messages) for key in by} |
+                     {'token': pc.list_flatten(tokens)})
+    table = table.filter(pc.not_equal(table['token'], ''))
+    counts = table.group_by(by + ['token']).aggregate([('token', 'count')]).to_pandas()
+    counts = counts.rename(columns={'token_count': 'count'}).sort_values(
+        by + ['count', 'token'], ascending=[True] * len(by) + [False, True], kind='stable', ignore_index=True)
+    if top:
+        counts = counts.groupby(by, sort=False).head(top).reset_index(drop=True)
+    return counts
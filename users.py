@@ -0,0 +1,44 @@
+import json
+import os
+import re
+
+# The people whose messages are served, read from data/users.json:
+#   {"kais": {"names": ["Kais", "Kais K."], "telegram_ids": ["user123456789"],
+#             "telegram": "data/users/kais/telegram.json", "whatsapp": "data/users/kais/whatsapp"}}
+# names are the owner's sender names in any export (case-insensitive), WhatsApp only knows those. telegram_ids
+# are the from_id of the owner's Telegram accounts, when left out the account the export belongs to is used.
+# Exports default to data/users/<user>/, every user has their own store under data/.cache/users/<user>/.
+# The first user is also served without the /<user> prefix.
+
+USERS_FILE = 'data/users.json'
+CACHE_ROOT = 'data/.cache'
+# Without a users.json: a single user reading the exports straight from data/
+DEFAULT_USERS = {'kais': {'names': ['kais'], 'telegram': 'data/telegram.json', 'whatsapp': 'data/whatsapp'}}
+# User names are URL path segments, and must not shadow a page
+USER_NAME = re.compile(r'[A-Za-z0-9_-]+')
+PAGE_NAMES = ['dms', 'groups', 'facts']
+
+
+def user_config(user, config):
+    if not USER_NAME.fullmatch(user) or user in PAGE_NAMES:
+        raise ValueError(f'invalid user name {user!r}')
+    folder = os.path.join('data', 'users', user)
+    return {
+        'names': config.get('names', [user]),
+        'telegram_ids': [str(telegram_id) for telegram_id in config.get('telegram_ids', [])],
+        'telegram': config.get('telegram', os.path.join(folder, 'telegram.json')),
+        'whatsapp': config.get('whatsapp', os.path.join(folder, 'whatsapp')),
+        'cache_dir': os.path.join(CACHE_ROOT, 'users', user),
+    }
+
+
+def load_users(path=USERS_FILE):
+    # user -> config with every key filled in, in file order
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+    except FileNotFoundError:
+        users = DEFAULT_USERS
+    if not users:
+        raise ValueError(f'{path} lists no users')
+    return {user: user_config(user, config) for user, config in users.items()}